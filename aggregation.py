@@ -0,0 +1,56 @@
+from typing import Dict, List, Tuple
+
+from messageformats import MessageFormats, escapeCode
+
+# Game event types that can be summarised
+EVENT_TYPES = ("deaths", "joins", "leaves")
+
+# Settings for channels that haven't set their own:
+# seconds to collect game events for before sending them, and the most of each type that are sent individually, any more in one go are summarised (0 to never)
+DEFAULT_SETTINGS = {"window": 0, "deaths": 0, "joins": 0, "leaves": 0}
+
+def countSuffix(count: int) -> str:
+	return f" ×{count}" if count > 1 else ""
+
+def renderDeath(formats: MessageFormats, death: tuple) -> str:
+	'''Render a death event as (victim, inflictor, attacker, suicide, no weapon)'''
+	if death[3] and not death[4]: # suicide with a weapon
+		return formats.render("suicide", victim=death[0], inflictor=death[1])
+	elif death[3]: # suicide without a weapon
+		return formats.render("suicideNoWeapon", victim=death[0])
+	elif not death[4]: # kill with a weapon
+		return formats.render("kill", victim=death[0], inflictor=death[1], attacker=death[2])
+	else: # kill without a weapon
+		return formats.render("killNoWeapon", victim=death[0], attacker=death[2])
+
+def summariseDeaths(formats: MessageFormats, deaths: List[tuple], threshold: int) -> List[str]:
+	'''
+	Render deaths individually, or if there are more than threshold, as a line per attacker and victim with how many times it happened
+	(at most threshold lines, then a count of the rest)
+	'''
+	if threshold == 0 or len(deaths) <= threshold: return [renderDeath(formats, death) for death in deaths]
+
+	counts: Dict[Tuple[str, str, bool], int] = {} # (victim, attacker, suicide), in order of first occurrence
+	for death in deaths:
+		key = (death[0], death[2], death[3])
+		counts[key] = counts.get(key, 0) + 1
+
+	lines = []
+	shown = 0
+	for (victim, attacker, suicide), count in counts.items():
+		if len(lines) == threshold:
+			lines.append(f"…and {len(deaths) - shown} more deaths")
+			break
+
+		if suicide: lines.append(formats.render("suicideNoWeapon", victim=victim) + countSuffix(count))
+		else: lines.append(formats.render("killNoWeapon", victim=victim, attacker=attacker) + countSuffix(count))
+		shown += count
+	return lines
+
+def summarisePlayers(formats: MessageFormats, names: List[str], threshold: int, category: str, verb: str) -> List[str]:
+	'''Render joins or leaves individually, or if there are more than threshold, as one line listing (up to threshold of) the players'''
+	if threshold == 0 or len(names) <= threshold: return [formats.render(category, player=name) for name in names]
+
+	listed = ", ".join(f"`{escapeCode(name)}`" for name in names[:threshold])
+	more = len(names) - threshold
+	return [f"{len(names)} players {verb}: {listed}" + (f" and {more} more" if more > 0 else "")]
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from time import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import re
+import sqlite3
+
+import aiohttp
+
+avatarPattern = re.compile(r"<avatarIcon><!\[CDATA\[(.*?)\]\]></avatarIcon>")
+
+DEFAULT_AVATAR = "http://example.com/"
+
+# Takes a steamID, returns the avatar URL or None if there isn't one
+Fetcher = Callable[[str], Awaitable[Optional[str]]]
+
+class SteamAvatarFetcher:
+	'''Fetches avatar URLs from steam community profiles'''
+	def __init__(self, baseURL: str = "http://steamcommunity.com", timeout: float = 10):
+		self.baseURL = baseURL
+		self.timeout = aiohttp.ClientTimeout(total=timeout)
+		self._session: Optional[aiohttp.ClientSession] = None
+
+	async def __call__(self, steamID: str) -> Optional[str]:
+		if self._session is None or self._session.closed:
+			self._session = aiohttp.ClientSession(timeout=self.timeout)
+
+		async with self._session.get(f"{self.baseURL}/profiles/{steamID}?xml=1") as response:
+			match = avatarPattern.search(await response.text())
+		return None if match is None else match.group(1)
+
+class AvatarStore:
+	'''On disk avatar cache (SQLite), so icons are available straight after a restart'''
+	def __init__(self, path: str):
+		self.path = path
+		self._db: Optional[sqlite3.Connection] = None
+
+	def _connect(self) -> sqlite3.Connection:
+		'''Open the database on first use, clearing out expired entries'''
+		if self._db is None:
+			self._db = sqlite3.connect(self.path)
+			self._db.execute("PRAGMA journal_mode=WAL")
+			self._db.execute("PRAGMA synchronous=NORMAL")
+			self._db.execute("CREATE TABLE IF NOT EXISTS avatars (steamID TEXT PRIMARY KEY, url TEXT, expires REAL NOT NULL)")
+			self._db.execute("DELETE FROM avatars WHERE expires < ?", (time(),))
+			self._db.commit()
+		return self._db
+
+	def get(self, steamID: str) -> Optional[Tuple[Optional[str], float]]:
+		'''Get the URL (None if the lookup failed) and expiry of a stored avatar'''
+		row = self._connect().execute("SELECT url, expires FROM avatars WHERE steamID = ?", (steamID,)).fetchone()
+		return None if row is None else (row[0], row[1])
+
+	def put(self, steamID: str, url: Optional[str], expires: float):
+		db = self._connect()
+		db.execute("INSERT OR REPLACE INTO avatars VALUES (?, ?, ?)", (steamID, url, expires))
+		db.commit()
+
+	def close(self):
+		if self._db is None: return
+		self._db.close()
+		self._db = None
+
+class AvatarResolver:
+	'''
+	Resolves steam avatar URLs without blocking, caching them in memory (LRU with expiry).
+	Failed lookups are cached for a shorter time, and concurrent lookups of the same steamID share one request.
+	'''
+	def __init__(self, fetch: Optional[Fetcher] = None, store: Optional[AvatarStore] = None, maxSize: int = 4096, ttl: float = 3600, negativeTtl: float = 300):
+		self.fetch = SteamAvatarFetcher() if fetch is None else fetch
+		self.store = store # Falls back to this when not cached in memory
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self.negativeTtl = negativeTtl
+
+		self._cache: Dict[str, Tuple[Optional[str], float]] = OrderedDict() # steamID: (URL or None, expiry)
+		self._inFlight: Dict[str, asyncio.Task] = {}
+
+	def get(self, steamID: str) -> Tuple[bool, Optional[str]]:
+		'''Get an avatar from the cache, returns whether it was cached and the URL (None if the lookup failed)'''
+		entry = self._cache.get(steamID)
+		if entry is None and self.store is not None:
+			entry = self.store.get(steamID)
+			if entry is not None: self._cache[steamID] = entry
+		if entry is None: return (False, None)
+
+		if entry[1] < time():
+			del self._cache[steamID]
+			return (False, None)
+
+		self._cache.move_to_end(steamID)
+		return (True, entry[0])
+
+	def put(self, steamID: str, url: Optional[str]):
+		'''Cache the result of a lookup'''
+		self._cache[steamID] = (url, time() + (self.ttl if url is not None else self.negativeTtl))
+		self._cache.move_to_end(steamID)
+		if self.store is not None: self.store.put(steamID, *self._cache[steamID])
+		while len(self._cache) > self.maxSize: self._cache.popitem(last=False)
+
+	def prefetch(self, steamID: str):
+		'''Start looking up an avatar in the background if it isn't cached (must be called on the event loop)'''
+		if steamID in self._inFlight or self.get(steamID)[0]: return
+		self._inFlight[steamID] = asyncio.get_running_loop().create_task(self._lookup(steamID))
+
+	async def resolve(self, steamID: str) -> str:
+		'''Get the avatar URL for a steamID, falling back to a placeholder if there isn't one'''
+		cached, url = self.get(steamID)
+		if not cached:
+			self.prefetch(steamID)
+			url = await asyncio.shield(self._inFlight[steamID])
+		return DEFAULT_AVATAR if url is None else url
+
+	async def _lookup(self, steamID: str) -> Optional[str]:
+		try:
+			try: url = await self.fetch(steamID)
+			except Exception as e:
+				print(f"Failed to get avatar of {steamID}: {e!r}")
+				url = None
+
+			self.put(steamID, url)
+			return url
+		finally: del self._inFlight[steamID]
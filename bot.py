@@ -1,12 +1,16 @@
 import os
 import atexit
 from dotenv import load_dotenv
-import json
 
 import discord
 from discord.ext import commands
 
-from nanosserver import NanosServer
+import nanosserver
+from dispatcher import Dispatcher
+from messageformats import MessageFormats
+from notifier import Notifier
+from persistence import DataStore
+from query import QueryClient
 
 from relay import Relay
 
@@ -20,44 +24,46 @@ PREFIX = os.getenv("COMMAND_PREFIX")
 TIME_DOWN_BEFORE_NOTIFY = int(os.getenv("TIME_DOWN_BEFORE_NOTIFY"))
 COLOUR = int(os.getenv("COLOUR"), 16)
 PORT = int(os.getenv("RELAY_PORT"))
+RELAY_ASYNCIO = os.getenv("RELAY_ASYNCIO", "1") == "1"
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", "10"))
+PAYLOAD_DEBOUNCE = float(os.getenv("PAYLOAD_DEBOUNCE", "1"))
+QUEUE_LIMITS = {category: int(limit) for category, _, limit in (pair.partition(":") for pair in os.getenv("QUEUE_LIMITS", "").split(",") if pair != "")}
+OVERFLOW_POLICY = os.getenv("OVERFLOW_POLICY", "summarise")
+DURABLE_QUEUE = os.getenv("DURABLE_QUEUE", "0") == "1"
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "60"))
+HEALTH_CHECK_CONCURRENCY = int(os.getenv("HEALTH_CHECK_CONCURRENCY", "20"))
+HEALTH_CHECK_MAX_BACKOFF = float(os.getenv("HEALTH_CHECK_MAX_BACKOFF", "900"))
+LIVENESS_TIMEOUT = float(os.getenv("LIVENESS_TIMEOUT", "45"))
+AGGREGATION = {setting: float(value) for setting, _, value in (pair.partition(":") for pair in os.getenv("AGGREGATION", "").split(",") if pair != "")}
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "5"))
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "2"))
+QUERY_RETRIES = int(os.getenv("QUERY_RETRIES", "2"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "5"))
 
 # Init relay http server
-r = Relay(PORT)
+r = Relay(
+	PORT, RELAY_ASYNCIO, os.path.join(os.path.dirname(os.path.realpath(__file__)), "avatars.db"), QUEUE_LIMITS, OVERFLOW_POLICY,
+	os.path.join(os.path.dirname(os.path.realpath(__file__)), "queue.db") if DURABLE_QUEUE else None
+)
 
-# Load data from json
-JSON = json.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "data.json"), "r"))
+# Server queries (pings, info, players) are shared and cached across every server
+nanosserver.queryClient = QueryClient(QUERY_TIMEOUT, QUERY_RETRIES, QUERY_CACHE_TTL)
 
-for channelID, connectionObj in JSON.items():
-	if JSON[channelID]["relay"] == 1: r.addConStr(connectionObj["server"])
-	JSON[channelID]["server"] = NanosServer(connectionObj["server"])
-	JSON[channelID]["time_since_down"] = -1
+# Load data from json (and any changes journaled since it was last written)
+store = DataStore(os.path.join(os.path.dirname(os.path.realpath(__file__)), "data.json"))
+registry = store.load()
 
-# Load custom message formats from json
-messageFormats = json.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "messageFormats.json"), "r"))
+for constring in registry.active: r.addConStr(constring)
 
-if "joinMsgs" not in messageFormats.keys() or len(messageFormats["joinMsgs"]) == 0:
-	messageFormats["joinMsgs"] = ["`{player}` just joined the server!"]
-if "leaveMsgs" not in messageFormats.keys() or len(messageFormats["leaveMsgs"]) == 0:
-	messageFormats["leaveMsgs"] = ["`{player}` just left the server"]
-
-if "suicide" not in messageFormats.keys() or len(messageFormats["suicide"]) == 0:
-	messageFormats["suicide"] = ["`{victim}` killed themselves with `{inflictor}`"]
-if "suicideNoWeapon" not in messageFormats.keys() or len(messageFormats["suicideNoWeapon"]) == 0:
-	messageFormats["suicideNoWeapon"] = ["`{victim}` killed themselves"]
-if "kill" not in messageFormats.keys() or len(messageFormats["kill"]) == 0:
-	messageFormats["kill"] = ["`{attacker}` killed `{victim}` with `{inflictor}`"]
-if "killNoWeapon" not in messageFormats.keys() or len(messageFormats["killNoWeapon"]) == 0:
-	messageFormats["killNoWeapon"] = ["`{attacker}` killed `{victim}`"]
+# Load custom message formats from json (reloaded whenever the file changes)
+messageFormats = MessageFormats(os.path.join(os.path.dirname(os.path.realpath(__file__)), "messageFormats.json"))
 
 # Define and register clean shutdown function
-def onExit(filepath: str):
+def onExit():
 	print("Performing safe shutdown")
+	store.compact()
 
-	for channelID, connectionObj in JSON.items():
-		JSON[channelID]["server"] = connectionObj["server"].getConstring()
-	json.dump(JSON, open(os.path.join(os.path.dirname(os.path.realpath(filepath)), "data.json"), "w"))
-
-atexit.register(onExit, __file__)
+atexit.register(onExit)
 
 # Set up intents
 intents = discord.Intents.default()
@@ -65,6 +71,11 @@ intents.members = True
 
 # Initialise bot
 bot = commands.Bot(PREFIX, case_insensitive=True, intents=intents)
-bot.add_cog(ServerCommands(bot, JSON, r, TIME_DOWN_BEFORE_NOTIFY, messageFormats))
-bot.add_cog(UserCommands(bot, JSON, COLOUR))
+dispatcher = Dispatcher(DISPATCH_CONCURRENCY)
+notifier = Notifier(store, dispatcher, NOTIFY_CONCURRENCY)
+bot.add_cog(ServerCommands(bot, store, r, notifier, dispatcher, TIME_DOWN_BEFORE_NOTIFY, messageFormats, PAYLOAD_DEBOUNCE,
+	HEALTH_CHECK_INTERVAL, HEALTH_CHECK_CONCURRENCY, HEALTH_CHECK_MAX_BACKOFF, LIVENESS_TIMEOUT, AGGREGATION
+))
+bot.add_cog(UserCommands(bot, store, notifier, COLOUR))
+bot.loop.create_task(r.start())
 bot.run(TOKEN)
@@ -0,0 +1,55 @@
+from collections import deque
+from typing import Hashable, List, Optional, Tuple
+
+# What happens to new items when a queue is full
+DROP_OLDEST = "drop-oldest" # Make room by discarding the oldest item
+DROP_NEWEST = "drop-newest" # Discard the new item
+SUMMARISE = "summarise" # Discard the new item, but count it so a summary can be sent in its place
+POLICIES = (DROP_OLDEST, DROP_NEWEST, SUMMARISE)
+
+class BoundedQueue:
+	'''
+	FIFO queue with a size cap, and a policy for what to do when it overflows.
+	Items can be tagged with a key (e.g. a journal ID), to find out which were discarded or drained.
+	'''
+	__slots__ = ("maxSize", "policy", "_items", "_skipped", "overflowed")
+
+	def __init__(self, maxSize: int, policy: str = DROP_OLDEST):
+		if policy not in POLICIES: raise ValueError(f"Invalid overflow policy {policy}")
+
+		self.maxSize = maxSize
+		self.policy = policy
+		self._items = deque() # (key, item)
+		self._skipped = 0 # Items discarded since the last summary (summarise policy only)
+		self.overflowed = 0 # Total items discarded
+
+	def __len__(self) -> int:
+		return len(self._items)
+
+	def append(self, item, key: Optional[Hashable] = None) -> Optional[Hashable]:
+		'''Add an item to the queue, returns the key of the item discarded to make room (if any)'''
+		if len(self._items) < self.maxSize:
+			self._items.append((key, item))
+			return None
+
+		self.overflowed += 1
+		if self.policy == DROP_OLDEST:
+			discarded = self._items.popleft()[0]
+			self._items.append((key, item))
+			return discarded
+
+		if self.policy == SUMMARISE: self._skipped += 1
+		return key
+
+	def drainWithKeys(self) -> Tuple[list, List[Hashable]]:
+		'''Remove and return all the items in the queue, and their keys'''
+		items = [item for _, item in self._items]
+		keys = [key for key, _ in self._items]
+		self._items.clear()
+		return items, keys
+
+	def takeSkipped(self) -> int:
+		'''Get the number of items discarded since this was last called, for the summarise policy'''
+		skipped = self._skipped
+		self._skipped = 0
+		return skipped
@@ -0,0 +1,49 @@
+from http.client import HTTPMessage
+import json
+
+try: import orjson
+except ImportError: orjson = None
+
+try: import msgpack
+except ImportError: msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+# Wire formats the relay can use, by MIME type (MessagePack only if installed)
+MIME_TYPES = (JSON, MSGPACK) if msgpack is not None else (JSON,)
+MIME_ALIASES = {"application/x-msgpack": MSGPACK}
+
+def dumps(obj) -> bytes:
+	'''Encode an object as JSON bytes, with orjson if it's installed'''
+	if orjson is not None: return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+	return bytes(json.dumps(obj), encoding="utf-8")
+
+def loads(data: bytes):
+	'''Decode JSON, with orjson if it's installed'''
+	if orjson is not None: return orjson.loads(data)
+	return json.loads(data)
+
+def encode(obj, mimeType: str = JSON) -> bytes:
+	'''Encode an object in one of `MIME_TYPES`'''
+	if mimeType == MSGPACK: return msgpack.packb(obj)
+	return dumps(obj)
+
+def decode(data: bytes, mimeType: str = JSON):
+	'''Decode data in one of `MIME_TYPES`, raises ValueError if it's invalid'''
+	if mimeType == MSGPACK:
+		try: return msgpack.unpackb(data)
+		except Exception as e: raise ValueError(str(e))
+	return loads(data)
+
+def getMimeType(value: str) -> str:
+	'''Get the MIME type from a Content-type or Accept value, without parameters'''
+	mimeType = value.partition(";")[0].strip().lower()
+	return MIME_ALIASES.get(mimeType, mimeType)
+
+def negotiate(headers: HTTPMessage) -> str:
+	'''Get the wire format to respond to a request with, JSON unless the client asks for something else'''
+	accepted = [getMimeType(value) for value in headers.get("Accept", "").split(",")]
+	for mimeType in accepted:
+		if mimeType in MIME_TYPES: return mimeType
+	return JSON
@@ -1,17 +1,27 @@
 from infopayload import InfoPayload
-import random
+from functools import partial
+import asyncio
+import math
+from datetime import timezone
 import time
 
 import discord
 from discord.ext import commands, tasks
 
 from relay import Relay
+from dispatcher import Dispatcher, CHAT
+from aggregation import DEFAULT_SETTINGS, EVENT_TYPES, summariseDeaths, summarisePlayers
+from healthcheck import HealthScheduler
+from messageformats import MessageFormats
+from notifier import Notifier
+from persistence import DataStore
+from registry import Connection
 
 from nanosserver import NanosError, NanosServer
 
 import re
 
-from typing import Dict, Sequence
+from typing import Dict, List, Optional, Sequence, Tuple
 
 urlPattern = re.compile(
 	r'^(?:http|ftp)s?://' # http:// or https://
@@ -22,26 +32,97 @@ urlPattern = re.compile(
 	r'(?:/?|[/?]\S+)$', re.IGNORECASE
 )
 
+def packLines(lines: List[str], limit: int, start: str = "") -> List[str]:
+	'''Join lines into as few blocks of at most limit characters as possible, with the first block continuing on from start'''
+	blocks = [start]
+	for line in lines:
+		for i in range(0, max(len(line), 1), limit): # Split up any lines that are too long on their own
+			part = line[i:i + limit]
+			if len(blocks[-1]) == 0: blocks[-1] = part
+			elif len(blocks[-1]) + 1 + len(part) <= limit: blocks[-1] += "\n" + part
+			else: blocks.append(part)
+	return blocks
+
+def groupByAuthor(msgs: List[dict]) -> List[List[dict]]:
+	'''Split relayed chat messages into runs of consecutive messages from the same author'''
+	groups = []
+	for msg in msgs:
+		if len(groups) != 0 and groups[-1][0]["steamID"] == msg["steamID"] and groups[-1][0]["name"] == msg["name"] and groups[-1][0]["teamName"] == msg["teamName"]:
+			groups[-1].append(msg)
+		else: groups.append([msg])
+	return groups
+
+class LastEmbed:
+	'''The last chat embed relayed to a channel, so consecutive messages from the same author can be appended to it'''
+	__slots__ = ("message", "steamID", "authorName", "icon", "description", "timestamp")
+
+	def __init__(self, message: discord.Message, steamID: Optional[str], authorName: str, icon: str, description: str, timestamp: float):
+		self.message = message
+		self.steamID = steamID # None if the embed was found in the channel history rather than sent by this session
+		self.authorName = authorName
+		self.icon = icon
+		self.description = description
+		self.timestamp = timestamp
+
+	def isFrom(self, msg: dict, authorName: str) -> bool:
+		'''Whether a relayed chat message has the same author as this embed'''
+		if self.authorName != authorName: return False
+		if self.steamID is None: return self.icon == msg["icon"]
+		return self.steamID == msg["steamID"]
+
 # Server admin commands (Note, these commands can be run in any channel by people who have manage server perms, even when told not to run)
 class ServerCommands(commands.Cog):
 	'''Server commands to be used by anyone with manager server permissions'''
 
-	def __init__(self, bot: commands.Bot, json: dict, relay: Relay, timeBeforeNotify: int, messageFormats: dict):
+	def __init__(
+		self, bot: commands.Bot, store: DataStore, relay: Relay, notifier: Notifier, dispatcher: Dispatcher, timeBeforeNotify: int, messageFormats: MessageFormats, payloadDebounce: float = 1,
+		healthInterval: float = 60, healthConcurrency: int = 20, maxBackoff: float = 900, livenessTimeout: float = 45,
+		aggregation: Optional[Dict[str, float]] = None
+	):
 		self.bot = bot
-		self.json = json
+		self.store = store
+		self.registry = store.registry
 		self.relay = relay
+		self.notifier = notifier
 		
-		# List for logging if a server was closed automatically or not
+		# Set of channel IDs whose server was closed automatically
 		self.autoclosed = set()
 
+		# Every server is health checked on its own timer, and those that are down are retried less and less often (up to maxBackoff seconds apart)
+		self.healthInterval = healthInterval
+		self.maxBackoff = maxBackoff
+		self.healthChecks = HealthScheduler(self.checkServer, healthConcurrency, errorInterval=healthInterval)
+		# Relayed servers are considered up without being probed until they haven't polled the relay for this many seconds
+		# (must be longer than the relay's max poll timeout)
+		self.livenessTimeout = livenessTimeout
+		self.downSince: Dict[int, float] = {} # When each server's checks started failing (monotonic time)
+		self.reopenAttempts: Dict[int, int] = {} # Failed attempts to reopen each automatically closed server
+
 		self.timeBeforeNotify = timeBeforeNotify
 		self.messageFormats = messageFormats
 
+		# Info payloads are only kept for guilds with an active relay
 		self.infoPayloads: Dict[int, InfoPayload] = {}
 
-		self.lastAuthor = ["", 0]
+		# Changes to a payload are only published once per debounce window, however many events there are
+		self.payloadDebounce = payloadDebounce
+		self.pendingPayloads: Dict[int, asyncio.TimerHandle] = {}
+
+		# Colour and top role name of message authors by guild ID then member ID (see authorStyle)
+		self.authorStyles: Dict[int, Dict[int, Tuple[str, str]]] = {}
+
+		# Last chat embed relayed to each channel ID, None if the channel's last message isn't one (missing if unknown)
+		self.lastEmbeds: Dict[int, Optional[LastEmbed]] = {}
+
+		# Aggregation settings for channels that haven't set their own
+		self.aggregationDefaults = {**DEFAULT_SETTINGS, **(aggregation or {})}
+		# When each channel's held game events are next due to be sent, and the timers to send them
+		self.eventsDue: Dict[int, float] = {}
+		self.pendingEvents: Dict[int, asyncio.TimerHandle] = {}
+
+		# Sends to each channel run on their own worker, so one rate limited channel doesn't stall the rest
+		self.dispatcher = dispatcher
 
-		self.pingServer.start()
 		self.getFromRelay.start()
 	
 	def getGuildInfo(self, guild: discord.Guild) -> InfoPayload:
@@ -52,36 +133,75 @@ class ServerCommands(commands.Cog):
 			
 			payload.setRoles(guild.roles)
 			payload.setEmotes(guild.emojis)
-			payload.setMembers(guild.members)
+
+			# Members are added in the background, as there can be enough of them to stall the bot
+			self.bot.loop.create_task(self.populateMembers(guild, payload))
 
 			self.infoPayloads[guild.id] = payload
 		return self.infoPayloads[guild.id]
+
+	async def populateMembers(self, guild: discord.Guild, payload: InfoPayload):
+		'''Add a guild's members to its payload, then send it out again'''
+		if await payload.setMembers(guild.members): self.updatePayloadConStrs(payload)
 	
 	def setupConStr(self, guild: discord.Guild, constr: str):
 		'''Perform initialisation for a new relaying constring'''
 		self.relay.addConStr(constr)
 		payload = self.getGuildInfo(guild)
 		payload.addConStr(constr)
-		self.relay.setInitPayload(constr, payload.encode())
+		self.relay.setInitPayload(constr, payload)
 	
 	def removeConStr(self, guild: discord.Guild, constr: str):
-		'''Perform deinitialisation of a relaying constring'''
+		'''Perform deinitialisation of a relaying constring (once its connection is no longer active in the registry)'''
 		self.relay.removeConStr(constr)
 		if guild.id in self.infoPayloads:
 			self.infoPayloads[guild.id].removeConStr(constr)
+			if not self.registry.activeInGuild(guild.id): del self.infoPayloads[guild.id]
+
+	def closeConnection(self, guild: discord.Guild, connection: Connection):
+		'''Close a connection's server, and stop relaying it if it was'''
+		wasActive = connection.active
+		self.registry.close(connection)
+		if wasActive: self.removeConStr(guild, connection.constring)
+
+	async def serverIsUp(self, connection: Connection, relayed: bool) -> bool:
+		'''
+		Probe a connection's server. Relayed servers are only up if the server itself answers, as the host can be up when the server isn't
+		(while they're polling the relay they aren't probed at all), other servers are only down if the probe fails, as a running server doesn't have to answer it
+		'''
+		try: return await connection.server.ping() is not None or not relayed
+		except NanosError: return False
+
+	async def reopenConnection(self, connection: Connection, force: bool = False) -> bool:
+		'''
+		Reopen a closed connection if its server is back up (by the same rules as health checks, a relayed server must have polled the relay recently or answer the probe),
+		returns whether it did. If forced, only a failed probe stops it (relayed servers then get the liveness timeout to start polling again)
+		'''
+		sinceSeen = self.relay.secondsSinceSeen(connection.constring) if connection.relay else None
+		if sinceSeen is None or sinceSeen >= self.livenessTimeout:
+			if not await self.serverIsUp(connection, connection.relay and not force): return False
+		self.registry.retry(connection)
+		return True
+
+	async def serverName(self, connection: Connection) -> str:
+		'''Get the name of a connection's server, or the last one it had if it can't be queried'''
+		try: return (await connection.server.getInfo()).name
+		except NanosError: return connection.server.lastInfo.name
 	
 	@commands.Cog.listener()
 	async def on_ready(self):
 		await self.bot.wait_until_ready()
 
-		for channelId, serverObj in self.json.items():
-			if serverObj["relay"] == 0: continue
-
-			channel = self.bot.get_channel(int(channelId))
+		for connection in self.registry:
+			channel = self.bot.get_channel(connection.channelID)
 			if channel is None: continue
 			if isinstance(channel, discord.abc.PrivateChannel): raise TypeError("This bot does not support private channels (DMs and group chats)")
 
-			self.setupConStr(channel.guild, serverObj["server"].getConstring())
+			self.registry.setGuild(connection, channel.guild.id)
+			if connection.active: self.setupConStr(channel.guild, connection.constring)
+
+			# Initial checks are spread over an interval, rather than all hitting at once on startup
+			if not connection.server.isClosed: self.healthChecks.schedule(connection.channelID, self.healthInterval)
 
 	async def cog_check(self, ctx: commands.Context):
 		'''Make sure the person using these commands has manage guild permissions'''
@@ -93,125 +213,116 @@ class ServerCommands(commands.Cog):
 	@commands.command()
 	async def connect(self, ctx: commands.Context, connectionString: str):
 		'''Adds a connection to a source server to this channel'''
-		channelID = str(ctx.channel.id)
-
 		# Validate the request
-		if channelID in self.json:
-			existingConnection = self.json[channelID]['server'].getConstring()
-			if connectionString == existingConnection:
+		connection = self.registry.get(ctx.channel.id)
+		if connection is not None:
+			if connectionString == connection.constring:
 				await ctx.message.reply("This channel is already connected to that server")
 				return
-			await ctx.message.reply(f"This channel is already connected to `{existingConnection}`, use `{self.bot.command_prefix}disconnect` to connect to a different server")
+			await ctx.message.reply(f"This channel is already connected to `{connection.constring}`, use `{self.bot.command_prefix}disconnect` to connect to a different server")
 			return
 
 		# Attempt to connect to the server provided
 		server = None
-		try: server = NanosServer(connectionString)
+		try:
+			server = NanosServer(connectionString)
+			await server.ping()
 		except NanosError as e: await ctx.message.reply("Error, " + e.rawMessage)
 		except ValueError: await ctx.message.reply("Connection string invalid")
 		else:
 			if server.isClosed: await ctx.message.reply("Failed to connect to server")
 			else:
-				self.json.update({channelID: {"server": server, "toNotify": [], "time_since_down": -1, "relay": 0}})
+				self.registry.add(Connection(ctx.channel.id, server, guildID=ctx.guild.id))
+				self.store.record(ctx.channel.id)
+				self.healthChecks.schedule(ctx.channel.id, self.healthInterval)
 				await ctx.message.reply("Successfully connected to server!")
 
 	@commands.command()
 	async def disconnect(self, ctx: commands.Context):
 		'''Removes this channel's connection to a source server'''
-		channelID = str(ctx.channel.id)
-		if channelID not in self.json: await ctx.message.reply("This channel isn't connected to a server"); return
-
-		if self.json[channelID]["relay"] == 1:
-			self.removeConStr(ctx.guild, self.json[channelID]['server'].getConstring())
-
-		del self.json[channelID]
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: await ctx.message.reply("This channel isn't connected to a server"); return
+
+		wasActive = connection.active
+		self.registry.remove(connection.channelID)
+		if wasActive: self.removeConStr(ctx.guild, connection.constring)
+
+		self.autoclosed.discard(connection.channelID)
+		self.healthChecks.unschedule(connection.channelID)
+		self.eventsDue.pop(connection.channelID, None)
+		self.downSince.pop(connection.channelID, None)
+		self.reopenAttempts.pop(connection.channelID, None)
+		self.store.record(connection.channelID)
 		await ctx.message.reply("Connection removed successfully!")
 
 	@commands.command()
 	async def close(self, ctx: commands.Context):
 		'''Closes the connection to the server'''
-		channelID = str(ctx.channel.id)
-		if channelID not in self.json: return
-		if self.json[channelID]["server"].isClosed: await ctx.message.reply("Server is already closed"); return
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: return
+		if connection.server.isClosed: await ctx.message.reply("Server is already closed"); return
 
-		if self.json[channelID]["relay"] == 1:
-			self.removeConStr(ctx.guild, self.json[channelID]['server'].getConstring())
-
-		self.json[channelID]["server"].close()
+		self.closeConnection(ctx.guild, connection)
 		await ctx.message.reply(f"Server closed successfully!\nReconnect with `{self.bot.command_prefix}retry`")
 
 	@commands.command()
 	async def retry(self, ctx: commands.Context):
 		'''Attempts to reconnect to the server'''
-		channelID = str(ctx.channel.id)
-		if channelID not in self.json: return
-		if not self.json[channelID]["server"].isClosed: await ctx.message.reply("Server is already connected"); return
-		serverCon = self.json[channelID]
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: return
+		if not connection.server.isClosed: await ctx.message.reply("Server is already connected"); return
 
-		serverCon["server"].retry()
-		if serverCon["server"].isClosed: await ctx.message.reply("Failed to reconnect to server")
+		if not await self.reopenConnection(connection, force=True): await ctx.message.reply("Failed to reconnect to server")
 		else:
-			if serverCon["relay"] == 1:
-				self.setupConStr(ctx.guild, self.json[channelID]["server"].getConstring())
+			if connection.active:
+				self.setupConStr(ctx.guild, connection.constring)
 			
-			self.json[channelID]["time_since_down"] = -1
+			connection.timeSinceDown = -1
+			self.healthChecks.schedule(connection.channelID, self.healthInterval)
 			await ctx.message.reply("Successfully reconnected to server!")
 
-			if channelID in self.autoclosed:
-				# Create a list of all valid user IDs
-				# This works by appending to this list every valid ID, then setting the toNotify list to this list of valid IDs
-				validIDs = []
-
-				info = serverCon["server"].getInfo()
-
-				# For every person set to be notified, send them a DM to say the server is back online
-				for personToNotify in serverCon["toNotify"]:
-					member = await ctx.guild.fetch_member(personToNotify)
-					if member is None: continue
-
-					validIDs.append(personToNotify)
+			if connection.channelID in self.autoclosed:
+				self.autoclosed.remove(connection.channelID)
+				self.reopenAttempts.pop(connection.channelID, None)
 
-					await member.send(f'''
-					The Source Dedicated Server `{info.name}` @ `{serverCon["server"].getConstring()}` assigned to this bot just came back up!\n*You are receiving this message as you are set to be notified regarding server outage at `{ctx.guild.name}`*
-					''')
-
-				self.json[channelID]["toNotify"] = validIDs
-				self.autoclosed.remove(channelID)
+				name = await self.serverName(connection)
+				self.bot.loop.create_task(self.notifier.notify(connection, ctx.guild, f"The Source Dedicated Server `{name}` @ `{connection.constring}` assigned to this bot just came back up!"))
 
 	@commands.command()
 	async def enableRelay(self, ctx: commands.Context):
 		'''Enables the relay in this channel'''
-		channelID = str(ctx.channel.id)
-		if channelID not in self.json: await ctx.message.reply("This channel is not connected to a server"); return
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: await ctx.message.reply("This channel is not connected to a server"); return
 
-		serverCon = self.json[channelID]
-		if serverCon["server"].isClosed: await ctx.message.reply("Server connection is closed"); return
+		if connection.server.isClosed: await ctx.message.reply("Server connection is closed"); return
 
-		if serverCon["relay"] == 1: await ctx.message.reply("The relay is already enabled"); return
+		if connection.relay: await ctx.message.reply("The relay is already enabled"); return
 
-		if self.relay.isConStrAdded(serverCon["server"].getConstring()):
+		if connection.constring in self.registry.active:
 			await ctx.message.reply("The relay is already handling this server in another channel, please disable it there first")
 			return
 
-		serverCon["relay"] = 1
+		self.registry.setRelay(connection, True)
+		self.store.record(connection.channelID)
 
 		# Init on relay server
-		self.setupConStr(ctx.guild, serverCon["server"].getConstring())
+		self.setupConStr(ctx.guild, connection.constring)
 		
 		await ctx.message.reply("Relay set successfully!")
 
 	@commands.command()
 	async def disableRelay(self, ctx: commands.Context):
 		'''Disables the relay in this channel'''
-		channelID = str(ctx.channel.id)
-		if channelID not in self.json: await ctx.message.reply("This channel is not connected to a server"); return
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: await ctx.message.reply("This channel is not connected to a server"); return
 
-		serverCon = self.json[channelID]
-		if serverCon["relay"] == 0: await ctx.message.reply("The relay is already disabled"); return
+		if not connection.relay: await ctx.message.reply("The relay is already disabled"); return
 
-		serverCon["relay"] = 0
+		wasActive = connection.active
+		self.registry.setRelay(connection, False)
+		self.store.record(connection.channelID)
 
-		if not serverCon["server"].isClosed: self.removeConStr(ctx.guild, serverCon["server"].getConstring())
+		if wasActive: self.removeConStr(ctx.guild, connection.constring)
 
 		await ctx.message.reply(f"Relay disabled, use `{self.bot.command_prefix}enableRelay` to re-enable")
 	
@@ -221,27 +332,68 @@ class ServerCommands(commands.Cog):
 		Runs a string in the relay client's console  
 		(may not be supported by all clients)
 		'''
-		channelID = str(ctx.channel.id)
-		if channelID not in self.json: await ctx.message.reply("This channel is not connected to a server"); return
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: await ctx.message.reply("This channel is not connected to a server"); return
 
-		serverCon = self.json[channelID]
-		if serverCon["server"].isClosed: await ctx.message.reply("The server is closed"); return
-		if serverCon["relay"] == 0: await ctx.message.reply("The relay isn't enabled for this server"); return
+		if connection.server.isClosed: await ctx.message.reply("The server is closed"); return
+		if not connection.active: await ctx.message.reply("The relay isn't enabled for this server"); return
 		
 		sanetised = ctx.message.content[len(self.bot.command_prefix + "rcon "):].replace("\n", ";")
 		if len(sanetised) == 0:
 			await ctx.message.reply("No command string specified")
 			return
 
-		self.relay.addRCON(sanetised, serverCon["server"].getConstring())
+		self.relay.addRCON(sanetised, connection.constring)
 		await ctx.message.reply(f"Command `{sanetised if len(sanetised) < 256 else sanetised[:256] + '...'}` queued")
 	
+	@commands.command()
+	async def queueStats(self, ctx: commands.Context):
+		'''Shows how many messages the relay has had to discard for this channel's server due to full queues'''
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: await ctx.message.reply("This channel is not connected to a server"); return
+		if not connection.active: await ctx.message.reply("The relay isn't enabled for this server"); return
+
+		counts = self.relay.getOverflowCounts(connection.constring)
+		await ctx.message.reply("Discarded messages:\n" + "\n".join(f"`{queue}`: {count}" for queue, count in counts.items()))
+
+	@commands.command()
+	async def aggregate(self, ctx: commands.Context, setting: str = None, value: str = None):
+		'''
+		Shows or changes how game events are summarised in this channel  
+		`window` is how many seconds to collect events for before sending them, and `deaths`, `joins` and `leaves` are the most of each that are sent individually, any more at once are summarised (0 to never).
+		Use `default` as the value to go back to the bot's default
+		'''
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: await ctx.message.reply("This channel is not connected to a server"); return
+
+		if setting is None:
+			settings = self.aggregationSettings(connection.channelID)
+			await ctx.message.reply("\n".join(
+				f"`{name}`: {settings[name]:g}" + ("" if name in connection.aggregation else " (default)")
+				for name in ("window",) + EVENT_TYPES
+			))
+			return
+
+		if setting not in ("window",) + EVENT_TYPES: await ctx.message.reply("Unknown setting, use one of `window`, " + ", ".join(f"`{name}`" for name in EVENT_TYPES)); return
+		if value is None: await ctx.message.reply(f"No value specified, see `{self.bot.command_prefix}help aggregate`"); return
+
+		if value == "default": connection.aggregation.pop(setting, None)
+		else:
+			try: number = float(value) if setting == "window" else int(value)
+			except ValueError: number = -1
+			if not math.isfinite(number) or number < 0: await ctx.message.reply("The value must be a positive number, 0, or `default`"); return
+			connection.aggregation[setting] = number
+
+		if setting == "window": self.resetEventWindow(connection)
+		self.store.record(connection.channelID)
+		await ctx.message.reply(f"`{setting}` set to {self.aggregationSettings(connection.channelID)[setting]:g}")
+
 	@commands.command()
 	async def constring(self, ctx: commands.Context):
 		'''Prints the current constring of the connected server'''
-		channelID = str(ctx.channel.id)
-		if channelID not in self.json: await ctx.message.reply("This channel is not connected to a server"); return
-		await ctx.message.reply(f"`{self.json[channelID]['server'].getConstring()}`")
+		connection = self.registry.get(ctx.channel.id)
+		if connection is None: await ctx.message.reply("This channel is not connected to a server"); return
+		await ctx.message.reply(f"`{connection.constring}`")
 
 	# Cog error handler
 	async def cog_command_error(self, ctx: commands.Context, error):
@@ -255,199 +407,292 @@ class ServerCommands(commands.Cog):
 
 	# Tasks
 	def cog_unload(self):
-		self.pingServer.cancel()
+		self.healthChecks.cancel()
 		self.getFromRelay.cancel()
+		self.dispatcher.cancel()
+		for handle in self.pendingPayloads.values(): handle.cancel()
+		for handle in self.pendingEvents.values(): handle.cancel()
+
+	async def checkServer(self, channelID: int) -> Optional[float]:
+		'''Health check for a connection's server, returns the time until it should next be checked (None to stop checking it)'''
+		connection = self.registry.get(channelID)
+		if connection is None: return None
+
+		channel = self.bot.get_channel(channelID)
+		if channel is None: return self.healthInterval # Channel isn't cached (yet)
+
+		if connection.server.isClosed:
+			if not channelID in self.autoclosed: return None # If the server was closed manually, it's checked again once it's retried
+
+			# Attempt to retry the connection to the server, backing off exponentially while it stays down
+			if not await self.reopenConnection(connection):
+				attempts = self.reopenAttempts.get(channelID, 0) + 1
+				self.reopenAttempts[channelID] = attempts
+				return min(self.healthInterval * 2 ** attempts, self.maxBackoff)
+
+			if connection.active:
+				self.setupConStr(channel.guild, connection.constring)
+
+			connection.timeSinceDown = -1
+			self.autoclosed.remove(channelID)
+			self.reopenAttempts.pop(channelID, None)
+
+			name = await self.serverName(connection)
+			self.bot.loop.create_task(self.notifier.notify(connection, channel.guild, f"The Source Dedicated Server `{name}` @ `{connection.constring}` assigned to this bot just came back up!"))
+			return self.healthInterval
+
+		# Relayed servers poll the relay constantly, so they're only probed once they stop
+		sinceSeen = self.relay.secondsSinceSeen(connection.constring) if connection.active else None
+		if sinceSeen is not None and sinceSeen < self.livenessTimeout:
+			self.downSince.pop(channelID, None)
+			if connection.timeSinceDown != -1: connection.timeSinceDown = -1
+			return max(self.livenessTimeout - sinceSeen, 1) # Check again once it would become stale
+
+		if not await self.serverIsUp(connection, connection.active):
+			# Minutes the server has been down for (since its last poll, if it was polling)
+			downSince = self.downSince.setdefault(channelID, time.monotonic() - (sinceSeen or 0))
+			connection.timeSinceDown = int((time.monotonic() - downSince) // 60)
+			if connection.timeSinceDown < self.timeBeforeNotify: return self.healthInterval
+
+			del self.downSince[channelID]
+			self.closeConnection(channel.guild, connection)
+			self.autoclosed.add(channelID)
+
+			self.bot.loop.create_task(self.notifier.notify(connection, channel.guild, f"**WARNING:** The Source Dedicated Server `{connection.server.lastInfo.name}` @ `{connection.constring}` assigned to this bot is down!"))
+		else:
+			self.downSince.pop(channelID, None)
+			if connection.timeSinceDown != -1: connection.timeSinceDown = -1
+		return self.healthInterval
 
-	@tasks.loop(minutes=1)
-	async def pingServer(self):
+	@tasks.loop()
+	async def getFromRelay(self):
 		await self.bot.wait_until_ready()
 
-		for channelID, serverCon in self.json.items():
-			if serverCon["server"].isClosed:
-				if not channelID in self.autoclosed: continue # If the server was closed manually just continue
-				
-				# Attempt to retry the connection to the server
-				serverCon["server"].retry()
-				if not serverCon["server"].isClosed:
-					guild = self.bot.get_channel(int(channelID)).guild
+		# Sleep until the relay receives something, then only handle the constrings that have data
+		ready = await self.relay.waitForReady()
 
-					if serverCon["relay"] == 1:
-						self.setupConStr(guild, serverCon["server"].getConstring())
+		for constring in ready:
+			connection = self.registry.active.get(constring)
+			if connection is None: continue
 
-					self.json[channelID]["time_since_down"] = -1
+			self.relayToChannel(connection.channelID, constring)
 
-					# Create a list of all valid user IDs
-					# This works by appending to this list every valid ID, then setting the toNotify list to this list of valid IDs
-					validIDs = []
+	def relayToChannel(self, channelIDInt: int, constring: str):
+		'''
+		Queue everything on the relay for a constring to be sent to its channel, chat first, then game events
+		(the relay is acknowledged once it's all been sent)
+		'''
+		channel = self.bot.get_channel(channelIDInt)
+		onIdle = partial(self.relay.ack, constring)
 
-					# For every person set to be notified, send them a DM to say the server is back online
-					for personToNotify in serverCon["toNotify"]:
-						member = await guild.fetch_member(personToNotify)
-						if member is None: continue
+		# Each run of messages from the same author is sent as a single embed (or appended to the last one) where possible
+		for group in groupByAuthor(self.relay.getMessages(constring)):
+			self.dispatcher.submit(channelIDInt, partial(self.relayChat, channel, group), CHAT, onIdle)
 
-						validIDs.append(personToNotify)
+		# Custom events aren't held for the aggregation window
+		lines = [body for body in self.relay.getCustom(constring) if len(body) != 0 and not body.isspace()]
 
-						guildName = guild.name
-						await member.send(f'''
-						The Source Dedicated Server `{serverCon["server"].getInfo().name}` @ `{serverCon["server"].getConstring()}` assigned to this bot just came back up!\n*You are receiving this message as you are set to be notified regarding server outage at `{guildName}`*
-						''')
+		# Handle death, join and leave events, which are held for the channel's aggregation window (if it has one) then summarised if there are enough
+		if self.eventsAreDue(channelIDInt, constring):
+			self.messageFormats.reloadIfChanged()
+			settings = self.aggregationSettings(channelIDInt)
 
-					self.json[channelID]["toNotify"] = validIDs
-					self.autoclosed.remove(channelID)
-				continue
-			try: serverCon["server"].ping()
-			except NanosError:
-				self.json[channelID]["time_since_down"] += 1
-				if serverCon["time_since_down"] < self.timeBeforeNotify: continue
+			lines.extend(summariseDeaths(self.messageFormats, self.relay.getDeaths(constring), int(settings["deaths"])))
 
-				guild = self.bot.get_channel(int(channelID)).guild
+			# Joins first incase someone joins then leaves in the same tenth of a second, so the leave message always comes after the join
+			joins, leaves = self.relay.getJoinsAndLeaves(constring)
+			lines.extend(summarisePlayers(self.messageFormats, joins, int(settings["joins"]), "joinMsgs", "joined"))
+			lines.extend(summarisePlayers(self.messageFormats, leaves, int(settings["leaves"]), "leaveMsgs", "left"))
 
-				# Create a list of all valid user IDs
-				# This works by appending to this list every valid ID, then setting the toNotify list to this list of valid IDs
-				validIDs = []
+			if len(lines) == 0: self.eventsDue.pop(channelIDInt, None) # Nothing was sent, so there's no need to hold the next events
 
-				for personToNotify in serverCon["toNotify"]:
-					member = await guild.fetch_member(personToNotify)
-					if member is None: continue
+		# Summaries of anything discarded because the relay's queues were full
+		lines.extend(self.relay.getOverflowSummaries(constring))
 
-					validIDs.append(personToNotify)
+		# Game events are combined into as few messages as possible (more so while the channel is rate limited)
+		if len(lines) != 0: self.dispatcher.submitLines(channelIDInt, lines, partial(self.sendEvent, channel), onIdle)
 
-					guildName = guild.name
-					await member.send(f'''
-					**WARNING:** The Source Dedicated Server `{serverCon["server"].getInfo().name}` @ `{serverCon["server"].getConstring()}` assigned to this bot is down!\n*You are receiving this message as you are set to be notified regarding server outage at `{guildName}`*
-					''')
+		if not self.dispatcher.busy(channelIDInt): self.relay.ack(constring)
 
-				self.json[channelID]["toNotify"] = validIDs
+	async def sendEvent(self, channel: discord.TextChannel, content: str):
+		'''Send a game event message to a channel'''
+		await channel.send(content)
+		self.lastEmbeds[channel.id] = None
 
-				serverCon["server"].close()
-				if serverCon["relay"] == 1:
-					self.removeConStr(guild, serverCon["server"].getConstring())
+	def aggregationSettings(self, channelID: int) -> Dict[str, float]:
+		'''Get the aggregation settings for a channel, with defaults for any it hasn't set'''
+		connection = self.registry.get(channelID)
+		if connection is None: return self.aggregationDefaults
+		return {**self.aggregationDefaults, **connection.aggregation}
 
-				self.autoclosed.add(channelID)
-			else:
-				if self.json[channelID]["time_since_down"] != -1: self.json[channelID]["time_since_down"] = -1
+	def eventsAreDue(self, channelID: int, constring: str) -> bool:
+		'''
+		Whether a channel's game events should be sent now, starting its aggregation window if they should.
+		Events that arrive in a window are held until the end of it (when another relay is queued for them), so they can be summarised together.
+		'''
+		now = time.monotonic()
+		due = self.eventsDue.get(channelID, 0)
+		if now < due:
+			if channelID not in self.pendingEvents: self.pendingEvents[channelID] = self.bot.loop.call_later(due - now, self.flushEvents, channelID, constring)
+			return False
 
-	@tasks.loop(seconds=0.1)
-	async def getFromRelay(self):
-		await self.bot.wait_until_ready()
+		window = self.aggregationSettings(channelID)["window"]
+		if window > 0: self.eventsDue[channelID] = now + window
+		else: self.eventsDue.pop(channelID, None)
+		return True
+
+	def resetEventWindow(self, connection: Connection):
+		'''End a channel's aggregation window early (e.g. when its length changes), sending any events held for it'''
+		self.eventsDue.pop(connection.channelID, None)
+		handle = self.pendingEvents.pop(connection.channelID, None)
+		if handle is not None: handle.cancel()
+		if connection.active: self.relayToChannel(connection.channelID, connection.constring)
+
+	def flushEvents(self, channelID: int, constring: str):
+		del self.pendingEvents[channelID]
+		connection = self.registry.get(channelID)
+		if connection is None or not connection.active or connection.constring != constring: return
+		self.relayToChannel(channelID, constring)
+
+	async def relayChat(self, channel: discord.TextChannel, group: List[dict]):
+		'''Relay consecutive chat messages from one author, appending to the last embed if it's theirs'''
+		msg = group[-1]
+		await self.relay.resolveIcon(msg)
+		authorName = f"[{msg['teamName']}] {msg['name']}"
+		colour = discord.Colour.from_rgb(*[int(val) for val in msg["teamColour"].split(",")])
+		lines = [chat["message"] for chat in group]
+
+		def makeEmbed(description: str) -> discord.Embed:
+			embed = discord.Embed(description=description, colour=colour)
+			embed.set_author(name=authorName, icon_url=msg["icon"])
+			return embed
+
+		blocks = packLines(lines, 4096)
+		last = await self.getLastEmbed(channel)
+		if last is not None and last.isFrom(msg, authorName) and time.time() - last.timestamp <= 420:
+			appended = packLines(lines, 4096, last.description)
+			if appended[0] != last.description: # At least one line fits in the last embed
+				try:
+					await last.message.edit(embed=makeEmbed(appended[0]))
+					last.description = appended[0]
+					blocks = appended[1:]
+				except discord.NotFound: pass # Embed was deleted, so send new ones
+
+		for block in blocks:
+			last = LastEmbed(await channel.send(embed=makeEmbed(block)), msg["steamID"], authorName, msg["icon"], block, time.time())
+			self.lastEmbeds[channel.id] = last
+
+		for line in lines:
+			if urlPattern.match(line) is not None: # Message is a URL by itself, post separately for the embed
+				await last.message.reply(line)
+				self.lastEmbeds[channel.id] = None
+
+	async def getLastEmbed(self, channel: discord.TextChannel) -> Optional[LastEmbed]:
+		'''Get the last chat embed relayed to a channel, only checking the channel history if it isn't known (e.g. after a restart)'''
+		if channel.id in self.lastEmbeds: return self.lastEmbeds[channel.id]
+
+		last = None
+		history = await channel.history(limit=1).flatten()
+		if (
+			len(history) != 0 and
+			history[0].author.id == self.bot.user.id and
+			len(history[0].embeds) != 0 and
+			history[0].embeds[0].description != discord.Embed.Empty and
+			history[0].embeds[0].author.name != discord.Embed.Empty # Only relayed chat embeds have an author
+		):
+			embed = history[0].embeds[0]
+			last = LastEmbed(
+				history[0], None, embed.author.name, embed.author.icon_url, embed.description,
+				history[0].created_at.replace(tzinfo=timezone.utc).timestamp()
+			)
 
-		for channelID in self.json.keys():
-			channelIDInt = int(channelID)
-			serverCon = self.json[channelID]
-			if serverCon["server"].isClosed or serverCon["relay"] == 0: continue
-
-			constring = serverCon["server"].getConstring()
-			msgs = self.relay.getMessages(constring)
-			for msg in msgs:
-				author = [msg["steamID"], time.time(), f"[{msg['teamName']}] {msg['name']}"]
-				lastMsg = (await self.bot.get_channel(channelIDInt).history(limit=1).flatten())[0]
-
-				if (
-					author[0] != self.lastAuthor[0] or
-					lastMsg.author.id != self.bot.user.id or
-					len(lastMsg.embeds) == 0 or
-					lastMsg.embeds[0].author.name != author[2] or
-					author[1] - self.lastAuthor[1] > 420 or
-					lastMsg.embeds[0].description == discord.Embed.Empty or
-					len(lastMsg.embeds[0].description) + len(msg["message"]) > 4096
-				):
-					embed = discord.Embed(description=msg["message"], colour=discord.Colour.from_rgb(*[int(val) for val in msg["teamColour"].split(",")]))
-					embed.set_author(name=author[2], icon_url=msg["icon"])
-					lastMsg = await self.bot.get_channel(channelIDInt).send(embed=embed)
-					self.lastAuthor = author
-				else:
-					embed = discord.Embed(description=lastMsg.embeds[0].description + "\n" + msg["message"], colour=discord.Colour.from_rgb(*[int(val) for val in msg["teamColour"].split(",")]))
-					embed.set_author(name=author[2], icon_url=msg["icon"])
-					await lastMsg.edit(embed=embed)
-				
-				if urlPattern.match(msg["message"]) is not None: # Message is a URL by itself, post separately for the embed
-					await lastMsg.reply(msg['message'])
-
-			# Handle custom events
-			custom = self.relay.getCustom(constring)
-			for body in custom:
-				if len(body) == 0 or body.isspace(): continue
-				await self.bot.get_channel(channelIDInt).send(body)
-
-			# Handle death events
-			deaths = self.relay.getDeaths(constring)
-			for death in deaths:
-				if death[3] and not death[4]: # suicide with a weapon
-					await self.bot.get_channel(channelIDInt).send(random.choice(self.messageFormats["suicide"]).replace("{victim}", death[0]).replace("{inflictor}", death[1]))
-				elif death[3]: # suicide without a weapon
-					await self.bot.get_channel(channelIDInt).send(random.choice(self.messageFormats["suicideNoWeapon"]).replace("{victim}", death[0]))
-				elif not death[4]: # kill with a weapon
-					await self.bot.get_channel(channelIDInt).send(random.choice(self.messageFormats["kill"]).replace("{victim}", death[0]).replace("{inflictor}", death[1]).replace("{attacker}", death[2]))
-				else: # kill without a weapon
-					await self.bot.get_channel(channelIDInt).send(random.choice(self.messageFormats["killNoWeapon"]).replace("{victim}", death[0]).replace("{attacker}", death[2]))
-
-			# Handle join and leave events
-			# (joins first incase someone joins then leaves in the same tenth of a second, so the leave message always comes after the join)
-			joinsAndLeaves = self.relay.getJoinsAndLeaves(constring)
-
-			for name in joinsAndLeaves[0]:
-				await self.bot.get_channel(channelIDInt).send(random.choice(self.messageFormats["joinMsgs"]).replace("{player}", name))
-			for name in joinsAndLeaves[1]:
-				await self.bot.get_channel(channelIDInt).send(random.choice(self.messageFormats["leaveMsgs"]).replace("{player}", name))
+		self.lastEmbeds[channel.id] = last
+		return last
 
 	@commands.Cog.listener()
 	async def on_message(self, msg: discord.Message):
-		channelID = str(msg.channel.id)
-		if msg.author.bot or channelID not in self.json or self.json[channelID]["relay"] == 0 or self.json[channelID]["server"].isClosed: return
+		# Most messages are in channels that aren't being relayed, so reject those first
+		if msg.channel.id not in self.registry.activeChannels:
+			if msg.channel.id in self.lastEmbeds: self.lastEmbeds[msg.channel.id] = None # Relay was disabled, so the embed can't be appended to either
+			return
 
-		if ( # If the message is using the command prefix, check if it's a valid command
-			len(msg.content) > len(self.bot.command_prefix) and
-			msg.content[:len(self.bot.command_prefix)] == self.bot.command_prefix
-		):
-			cmdText = msg.content[len(self.bot.command_prefix):].split()[0]
-			for cmd in self.bot.commands:
-				if cmd.name == cmdText: return # Don't relay the message if it's a valid bot command
+		# Any message other than the tracked chat embed (including the bot's other embeds, e.g. command replies) means it can no longer be appended to
+		last = self.lastEmbeds.get(msg.channel.id)
+		if last is not None and msg.id != last.message.id: self.lastEmbeds[msg.channel.id] = None
+
+		if msg.author.bot: return
 
-		constring = self.json[channelID]["server"].getConstring()
-		if msg.author.colour.value == 0: colour = (255, 255, 255)
-		else: colour = msg.author.colour.to_rgb()
-		if len(msg.content) != 0: self.relay.addMessage((msg.author.display_name, msg.content, "%02x%02x%02x" % colour, msg.author.top_role.name, msg.clean_content), constring)
+		# Don't relay the message if it's a valid bot command (all_commands is kept up to date by discord.py, and includes aliases)
+		prefix = self.bot.command_prefix
+		if msg.content.startswith(prefix) and len(msg.content) > len(prefix):
+			words = msg.content[len(prefix):].split(maxsplit=1)
+			if len(words) != 0 and words[0] in self.bot.all_commands: return
+
+		constring = self.registry.get(msg.channel.id).constring
+		colour, role = self.authorStyle(msg.author)
+		if len(msg.content) != 0: self.relay.addMessage((msg.author.display_name, msg.content, colour, role, msg.clean_content), constring)
 
 		for attachment in msg.attachments:
-			self.relay.addMessage((msg.author.display_name, attachment.url, "%02x%02x%02x" % colour, msg.author.top_role.name, attachment.url), constring)
+			self.relay.addMessage((msg.author.display_name, attachment.url, colour, role, attachment.url), constring)
+
+	def authorStyle(self, member: discord.Member) -> Tuple[str, str]:
+		'''Get a member's colour (as hex) and top role name for relayed messages, cached until their roles or the guild's change'''
+		styles = self.authorStyles.setdefault(member.guild.id, {})
+		if member.id not in styles:
+			colour = (255, 255, 255) if member.colour.value == 0 else member.colour.to_rgb()
+			styles[member.id] = ("%02x%02x%02x" % colour, member.top_role.name)
+		return styles[member.id]
 	
 	# InfoPayload Updaters
 	def updatePayloadConStrs(self, payload: InfoPayload):
-		'''Goes through every constring using this payload and sends them the new data'''
+		'''Schedule the payload to be sent to every constring using it, if it isn't already'''
+		if id(payload) in self.pendingPayloads: return
+		self.pendingPayloads[id(payload)] = self.bot.loop.call_later(self.payloadDebounce, self.publishPayload, payload)
+
+	def publishPayload(self, payload: InfoPayload):
+		'''Encode the payload once, and flag it as changed to every constring using it'''
+		del self.pendingPayloads[id(payload)]
+		if len(payload.constrs) == 0: return
+
+		payload.encode()
 		for constr in payload.constrs:
-			self.relay.setInitPayload(constr, payload.encode())
+			self.relay.setInitPayload(constr, payload)
 
 	@commands.Cog.listener()
 	async def on_member_join(self, member: discord.Member):
-		self.getGuildInfo(member.guild).updateMember(member)
-		self.updatePayloadConStrs(self.infoPayloads[member.guild.id])
+		payload = self.infoPayloads.get(member.guild.id)
+		if payload is not None and payload.updateMember(member): self.updatePayloadConStrs(payload)
 
 	@commands.Cog.listener()
 	async def on_member_remove(self, member: discord.Member):
-		self.getGuildInfo(member.guild).removeMember(member)
-		self.updatePayloadConStrs(self.infoPayloads[member.guild.id])
+		self.authorStyles.get(member.guild.id, {}).pop(member.id, None)
+		payload = self.infoPayloads.get(member.guild.id)
+		if payload is not None and payload.removeMember(member): self.updatePayloadConStrs(payload)
 
 	@commands.Cog.listener()
 	async def on_member_update(self, _: discord.Member, after: discord.Member):
-		self.getGuildInfo(after.guild).updateMember(after)
-		self.updatePayloadConStrs(self.infoPayloads[after.guild.id])
+		self.authorStyles.get(after.guild.id, {}).pop(after.id, None)
+		payload = self.infoPayloads.get(after.guild.id)
+		if payload is not None and payload.updateMember(after): self.updatePayloadConStrs(payload)
 
 	@commands.Cog.listener()
 	async def on_guild_role_create(self, role: discord.Role):
-		self.getGuildInfo(role.guild).updateRole(role)
-		self.updatePayloadConStrs(self.infoPayloads[role.guild.id])
+		payload = self.infoPayloads.get(role.guild.id)
+		if payload is not None and payload.updateRole(role): self.updatePayloadConStrs(payload)
 
 	@commands.Cog.listener()
 	async def on_guild_role_delete(self, role: discord.Role):
-		self.getGuildInfo(role.guild).removeRole(role)
-		self.updatePayloadConStrs(self.infoPayloads[role.guild.id])
+		self.authorStyles.pop(role.guild.id, None) # Role changes can affect any number of members' colour and top role
+		payload = self.infoPayloads.get(role.guild.id)
+		if payload is not None and payload.removeRole(role): self.updatePayloadConStrs(payload)
 
 	@commands.Cog.listener()
 	async def on_guild_role_update(self, _: discord.Role, after: discord.Role):
-		self.getGuildInfo(after.guild).updateRole(after)
-		self.updatePayloadConStrs(self.infoPayloads[after.guild.id])
+		self.authorStyles.pop(after.guild.id, None)
+		payload = self.infoPayloads.get(after.guild.id)
+		if payload is not None and payload.updateRole(after): self.updatePayloadConStrs(payload)
 	
 	@commands.Cog.listener()
 	async def on_guild_emojis_update(self, guild: discord.Guild, _: Sequence[discord.Emoji], after: Sequence[discord.Emoji]):
-		self.getGuildInfo(guild).setEmotes(after)
-		self.updatePayloadConStrs(self.infoPayloads[guild.id])
+		payload = self.infoPayloads.get(guild.id)
+		if payload is not None and payload.setEmotes(after): self.updatePayloadConStrs(payload)
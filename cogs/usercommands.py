@@ -5,6 +5,8 @@ import discord
 from discord.ext import commands
 
 from nanosserver import NanosError
+from notifier import Notifier
+from persistence import DataStore
 
 def formatTimedelta(delta: timedelta) -> str:
 	'''Utility to convert timedelta to formatted string'''
@@ -23,31 +25,48 @@ def formatTimedelta(delta: timedelta) -> str:
 class UserCommands(commands.Cog):
 	'''Commands to be run by any user in a channel with a connection'''
 
-	def __init__(self, bot: commands.Bot, json: dict, embedColour: int):
+	def __init__(self, bot: commands.Bot, store: DataStore, notifier: Notifier, embedColour: int):
 		self.bot = bot
-		self.json = json
+		self.store = store
+		self.registry = store.registry
+		self.notifier = notifier
 		self.embedColour = embedColour
 
 	@commands.command()
 	async def status(self, ctx):
 		'''Tells you whether the connection to the server is closed, invalid, or open'''
 		ping = None
-		try: ping = self.json[str(ctx.channel.id)]["server"].ping()
+		try: ping = await self.registry.get(ctx.channel.id).server.ping()
 		except NanosError as e:
 			await ctx.message.reply("Connection to server isn't closed internally, however failed to ping the server with exception `" + e.message + "`")
 			return
 		
-		await ctx.message.reply("Server online, ping %d. (Note that the ping is from the location of the bot)" % ping)
+		if ping is None: await ctx.message.reply("The server didn't answer a ping, so its status is unknown (a running Nanos World server doesn't have to answer, but neither does a host that's down)")
+		else: await ctx.message.reply("Server online, ping %d. (Note that the ping is from the location of the bot)" % ping)
 
 	@commands.command()
 	async def info(self, ctx: commands.Context, infoName: str = None):
 		'''Gets server info, all if no name specified'''
-		await ctx.message.reply("Not implemented yet")
+		try: info = vars(await self.registry.get(ctx.channel.id).server.getInfo())
+		except NanosError as e: await ctx.message.reply("Error, " + e.rawMessage); return
+		if infoName is not None:
+			if infoName not in info: await ctx.message.reply(f"No info named `{infoName}`, the server has: " + ", ".join(f"`{name}`" for name in info)); return
+			await ctx.message.reply(f"`{infoName}`: `{info[infoName]}`")
+			return
+
+		embed = discord.Embed(title="Server Info", colour=self.embedColour)
+		for name, value in info.items(): embed.add_field(name=name, value=str(value))
+		await ctx.message.reply(embed=embed)
 
 	@commands.command()
 	async def players(self, ctx):
 		'''Gets all players on the server'''
-		await ctx.message.reply("Not implemented yet")
+		try: players = await self.registry.get(ctx.channel.id).server.getPlayers()
+		except NanosError as e: await ctx.message.reply("Error, " + e.rawMessage); return
+		if len(players) == 0: await ctx.message.reply("No players are on the server"); return
+
+		names = ", ".join(f"`{player.name}`" for player in players)
+		await ctx.message.reply(embed=discord.Embed(title=f"{len(players)} Player{'s' if len(players) != 1 else ''}", description=names[:4096], colour=self.embedColour))
 
 	@commands.command()
 	async def rules(self, ctx, ruleName: str = None):
@@ -72,9 +91,11 @@ class UserCommands(commands.Cog):
 
 		if target.bot: await ctx.message.reply("Bots cannot be notified regarding server outage"); return
 
-		if target.id in self.json[str(ctx.channel.id)]["toNotify"]: await ctx.message.reply("Already configured to notify " + ("you" if affectingSelf else f"<@{target.id}>"))
+		connection = self.registry.get(ctx.channel.id)
+		if target.id in connection.toNotify: await ctx.message.reply("Already configured to notify " + ("you" if affectingSelf else f"<@{target.id}>"))
 		else:
-			self.json[str(ctx.channel.id)]["toNotify"].append(target.id)
+			connection.toNotify.append(target.id)
+			self.store.record(connection.channelID)
 			await ctx.message.reply(("You" if affectingSelf else f"<@{target.id}>") + " will now be notified regarding server outage")
 
 	@commands.command()
@@ -90,9 +111,11 @@ class UserCommands(commands.Cog):
 				return
 		else: target = ctx.message.author
 
-		if target.id not in self.json[str(ctx.channel.id)]["toNotify"]: await ctx.message.reply("Already configured to not notify " + ("you" if affectingSelf else f"<@{target.id}>"))
+		connection = self.registry.get(ctx.channel.id)
+		if target.id not in connection.toNotify: await ctx.message.reply("Already configured to not notify " + ("you" if affectingSelf else f"<@{target.id}>"))
 		else:
-			self.json[str(ctx.channel.id)]["toNotify"].remove(target.id)
+			connection.toNotify.remove(target.id)
+			self.store.record(connection.channelID)
 			await ctx.message.reply(("You" if affectingSelf else f"<@{target.id}>") + " will no longer be notified regarding server outage")
 
 	@commands.command()
@@ -101,35 +124,27 @@ class UserCommands(commands.Cog):
 		Lists all people set to be notified
 		'''
 
-		if len(self.json[str(ctx.channel.id)]["toNotify"]) == 0: # If no one is set to be notified don't bother building a message
+		connection = self.registry.get(ctx.channel.id)
+		if len(connection.toNotify) == 0: # If no one is set to be notified don't bother building a message
 			await ctx.message.reply(f"No one is set to be notified regarding server outage\n*use `{self.bot.command_prefix}notify` to mark yourself to be notified, and `{self.bot.command_prefix}dontNotify` to disable notifications*")
 			return
 
-		# As with the actual ping task, we save a list of valid IDs and replace the existing list with this one after the loop
-		validIDs = []
+		members = await self.notifier.resolve(connection, ctx.guild)
+		if len(members) == 0: await ctx.message.reply("No one set to be notified is still in this server"); return
 
-		# Message to be sent
 		msg = "*The following people are set to be notified regarding outage from the server linked to this channel:*\n"
-
-		for userID in self.json[str(ctx.channel.id)]["toNotify"]:
-			member = await ctx.guild.fetch_member(userID)
-			if member is None: continue
-
-			validIDs.append(userID)
-			msg += (f"<@{ctx.message.author.id}>" if ctx.message.author.id == userID else "`" + member.display_name + "`") + ", "
-
-		self.json[str(ctx.channel.id)]["toNotify"] = validIDs
-		await ctx.message.reply(msg[:-2])
+		msg += ", ".join(f"<@{member.id}>" if ctx.message.author.id == member.id else "`" + member.display_name + "`" for member in members)
+		await ctx.message.reply(msg)
 
 	# Command validity checks
 	async def cog_check(self, ctx):
-		if str(ctx.channel.id) not in self.json: return False
+		if ctx.channel.id not in self.registry: return False
 
 		# Handle autogenerated help command
 		prefixLen = len(self.bot.command_prefix)
 		if ctx.message.content[prefixLen:(prefixLen + 4)] == "help": return True
 
-		if self.json[str(ctx.channel.id)]["server"].isClosed:
+		if self.registry.get(ctx.channel.id).server.isClosed:
 			await ctx.message.reply("Server is closed, please try again later")
 			return False
 
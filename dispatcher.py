@@ -0,0 +1,185 @@
+import asyncio
+import heapq
+import itertools
+import time
+import traceback
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+
+Job = Callable[[], Awaitable]
+
+# Priority classes of outbound traffic, most urgent first
+CHAT = 0 # Relayed chat
+ALERT = 1 # Outage notifications
+EVENT = 2 # Kills, joins, leaves and other game events
+PRIORITIES = (CHAT, ALERT, EVENT)
+
+class TokenBucket:
+	'''Client side estimate of a Discord rate limit bucket, so sends can be paced instead of waiting inside discord.py'''
+	__slots__ = ("rate", "per", "tokens", "updated")
+
+	def __init__(self, rate: int, per: float):
+		self.rate = rate
+		self.per = per
+		self.tokens = float(rate)
+		self.updated = time.monotonic()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+		self.updated = now
+
+	def delay(self) -> float:
+		'''Seconds until a token is available'''
+		self._refill()
+		return 0 if self.tokens >= 1 else (1 - self.tokens) * self.per / self.rate
+
+	def take(self):
+		self._refill()
+		self.tokens -= 1
+
+class PrioritySlots:
+	'''Semaphore that hands freed slots to the most urgent waiter first'''
+	def __init__(self, size: int):
+		self._free = size
+		self._waiters = [] # Heap of (priority, order, future)
+		self._order = itertools.count()
+
+	async def acquire(self, priority: int):
+		if self._free > 0 and len(self._waiters) == 0:
+			self._free -= 1
+			return
+
+		future = asyncio.get_running_loop().create_future()
+		heapq.heappush(self._waiters, (priority, next(self._order), future))
+		try: await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled(): self.release() # Slot was handed over as this was cancelled
+			raise
+
+	def release(self):
+		while len(self._waiters) != 0:
+			future = heapq.heappop(self._waiters)[2]
+			if not future.done():
+				future.set_result(None)
+				return
+		self._free += 1
+
+class Route:
+	'''Outbound traffic waiting to be sent to a route'''
+	__slots__ = ("bucket", "jobs", "lines", "sendLines", "dropped", "onIdle", "worker")
+
+	def __init__(self, bucket: TokenBucket):
+		self.bucket = bucket
+		self.jobs = {priority: deque() for priority in PRIORITIES}
+		self.lines = deque() # Game event lines, merged into as few messages as possible when sent
+		self.sendLines: Optional[Callable[[str], Awaitable]] = None
+		self.dropped = 0 # Lines dropped since the last were sent
+		self.onIdle: Optional[Callable[[], None]] = None
+		self.worker: Optional[asyncio.Task] = None
+
+	def __bool__(self) -> bool:
+		return len(self.lines) != 0 or any(len(jobs) != 0 for jobs in self.jobs.values())
+
+class Dispatcher:
+	'''
+	Sends outbound traffic on a worker per route (a channel ID, the major parameter of Discord's message routes), so a channel that's being rate limited only delays itself.
+	Each route paces itself with a token bucket matching Discord's message limit, and always sends its most urgent item next,
+	so chat doesn't wait behind a flood of game events. Event lines pile up while a route is out of tokens and are merged into as few messages as possible,
+	with the oldest dropped once more than maxLines are waiting.
+	A cap on running jobs keeps the bot under the global rate limit, with freed slots going to the most urgent job first.
+	'''
+	def __init__(self, maxConcurrent: int = 10, rate: int = 5, per: float = 5, maxLines: int = 500, messageLimit: int = 2000):
+		self.rate = rate
+		self.per = per
+		self.maxLines = maxLines
+		self.messageLimit = messageLimit
+
+		self._slots = PrioritySlots(maxConcurrent)
+		self._routes: Dict[Hashable, Route] = {} # Only routes with something waiting
+		self._buckets: Dict[Hashable, TokenBucket] = {} # Kept when a route goes idle, so its rate limit carries over
+
+	def _route(self, key: Hashable) -> Route:
+		if key not in self._routes:
+			if key not in self._buckets: self._buckets[key] = TokenBucket(self.rate, self.per)
+			self._routes[key] = Route(self._buckets[key])
+		return self._routes[key]
+
+	def _wake(self, key: Hashable, route: Route, onIdle: Optional[Callable[[], None]]):
+		if onIdle is not None: route.onIdle = onIdle
+		if route.worker is None: route.worker = asyncio.get_running_loop().create_task(self._work(key, route))
+
+	def submit(self, key: Hashable, job: Job, priority: int = CHAT, onIdle: Optional[Callable[[], None]] = None):
+		'''Queue a job for a route, onIdle is called once everything queued for the route has been sent'''
+		route = self._route(key)
+		route.jobs[priority].append(job)
+		self._wake(key, route, onIdle)
+
+	def submitLines(self, key: Hashable, lines: List[str], send: Callable[[str], Awaitable], onIdle: Optional[Callable[[], None]] = None):
+		'''Queue game event lines for a route, to be sent in blocks of up to messageLimit characters with send'''
+		route = self._route(key)
+		route.lines.extend(lines)
+		route.sendLines = send
+		while len(route.lines) > self.maxLines:
+			route.lines.popleft()
+			route.dropped += 1
+		self._wake(key, route, onIdle)
+
+	def busy(self, key: Hashable) -> bool:
+		'''Whether a route has anything waiting to be sent'''
+		return key in self._routes
+
+	@asynccontextmanager
+	async def slot(self, priority: int):
+		'''Hold one of the running job slots (for traffic that doesn't go through a route)'''
+		await self._slots.acquire(priority)
+		try: yield
+		finally: self._slots.release()
+
+	def cancel(self):
+		'''Stop all workers, dropping anything queued'''
+		for route in self._routes.values():
+			if route.worker is not None: route.worker.cancel()
+		self._routes = {}
+
+	def _next(self, route: Route):
+		'''Take the most urgent item from a route, as (priority, job)'''
+		for priority in PRIORITIES:
+			if len(route.jobs[priority]) != 0: return priority, route.jobs[priority].popleft()
+
+		parts = []
+		if route.dropped != 0:
+			parts.append(f"…{route.dropped} earlier events were dropped")
+			route.dropped = 0
+
+		size = sum(len(part) + 1 for part in parts)
+		while len(route.lines) != 0:
+			line = route.lines[0]
+			if len(line) > self.messageLimit and len(parts) == 0: # Split up any lines that are too long on their own
+				route.lines[0] = line[self.messageLimit:]
+				parts.append(line[:self.messageLimit])
+				break
+			if size + len(line) > self.messageLimit: break
+
+			parts.append(route.lines.popleft())
+			size += len(line) + 1
+		return EVENT, partial(route.sendLines, "\n".join(parts))
+
+	async def _work(self, key: Hashable, route: Route):
+		try:
+			while route:
+				# The item is chosen after waiting for the bucket, so anything more urgent that arrived in the meantime goes first
+				delay = route.bucket.delay()
+				if delay > 0: await asyncio.sleep(delay)
+
+				priority, job = self._next(route)
+				route.bucket.take()
+				async with self.slot(priority):
+					try: await job()
+					except Exception: traceback.print_exc()
+		finally:
+			if self._routes.get(key) is route:
+				del self._routes[key]
+				if route.onIdle is not None: route.onIdle()
@@ -0,0 +1,65 @@
+from threading import Lock
+from typing import Iterable, List, Tuple
+import sqlite3
+
+import codec
+
+class DurableLog:
+	'''
+	Write-ahead log of queued relay messages (SQLite in WAL mode), so they survive a restart.
+	Writes are buffered and committed together by `flush`, amortising the cost of each fsync over every message since the last one.
+	'''
+	def __init__(self, path: str):
+		self.path = path
+		self._lock = Lock() # Guards the pending writes, messages can be logged from the threaded engine's request threads
+		self._dbLock = Lock() # Guards the connection, held across commits so appending and acking never wait on an fsync
+
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("PRAGMA synchronous=FULL")
+		self._db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, constring TEXT NOT NULL, direction TEXT NOT NULL, category TEXT NOT NULL, item BLOB NOT NULL)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS messages_constring ON messages (constring)")
+		self._db.commit()
+
+		self._nextID = (self._db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0) + 1
+		self._pendingInserts: List[Tuple[int, str, str, str, bytes]] = []
+		self._pendingDeletes: List[Tuple[int]] = []
+
+	@property
+	def dirty(self) -> bool:
+		return len(self._pendingInserts) != 0 or len(self._pendingDeletes) != 0
+
+	def append(self, constring: str, direction: str, category: str, item) -> int:
+		'''Log a queued message (written on the next flush), returns its ID'''
+		with self._lock:
+			id = self._nextID
+			self._nextID += 1
+			self._pendingInserts.append((id, constring, direction, category, codec.dumps(item)))
+		return id
+
+	def ack(self, ids: Iterable[int]):
+		'''Remove delivered (or discarded) messages from the log (on the next flush)'''
+		with self._lock: self._pendingDeletes.extend((id,) for id in ids if id is not None)
+
+	def flush(self):
+		'''Commit everything logged or acknowledged since the last flush'''
+		with self._dbLock: # Taken first, so flushes commit in the order their writes were swapped out
+			with self._lock:
+				if not self.dirty: return
+				inserts, self._pendingInserts = self._pendingInserts, []
+				deletes, self._pendingDeletes = self._pendingDeletes, []
+
+			self._db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", inserts)
+			self._db.executemany("DELETE FROM messages WHERE id = ?", deletes)
+			self._db.commit()
+
+	def replay(self, constring: str) -> List[Tuple[int, str, str, object]]:
+		'''Get the logged messages for a constring, oldest first, as (id, direction, category, item)'''
+		self.flush()
+		with self._dbLock:
+			rows = self._db.execute("SELECT id, direction, category, item FROM messages WHERE constring = ? ORDER BY id", (constring,)).fetchall()
+		return [(id, direction, category, codec.loads(item)) for id, direction, category, item in rows]
+
+	def close(self):
+		self.flush()
+		with self._dbLock: self._db.close()
@@ -0,0 +1,51 @@
+import asyncio
+import random
+import traceback
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+# A check returns how long to wait before running it again in seconds, or None to stop checking
+Check = Callable[[Hashable], Awaitable[Optional[float]]]
+
+class HealthScheduler:
+	'''
+	Runs a health check for each server on its own timer, so a slow server only delays its own checks.
+	Delays are jittered so checks don't all line up, and a cap on running checks bounds the load however many servers there are.
+	'''
+	def __init__(self, check: Check, maxConcurrent: int = 20, jitter: float = 0.1, errorInterval: float = 60):
+		self.check = check
+		self.jitter = jitter
+		self.errorInterval = errorInterval # Time to wait after a check raises before running it again
+
+		self._semaphore = asyncio.Semaphore(maxConcurrent)
+		self._timers: Dict[Hashable, asyncio.Task] = {}
+
+	def schedule(self, key: Hashable, spread: float = 0):
+		'''Start checking a server (if it isn't being checked already), first after a random delay of up to spread seconds'''
+		if key in self._timers: return
+		self._timers[key] = asyncio.get_running_loop().create_task(self._run(key, random.uniform(0, spread)))
+
+	def unschedule(self, key: Hashable):
+		'''Stop checking a server'''
+		timer = self._timers.pop(key, None)
+		if timer is not None: timer.cancel()
+
+	def cancel(self):
+		'''Stop checking every server'''
+		for timer in self._timers.values(): timer.cancel()
+		self._timers = {}
+
+	async def _run(self, key: Hashable, delay: float):
+		try:
+			while True:
+				await asyncio.sleep(delay)
+
+				async with self._semaphore:
+					try: interval = await self.check(key)
+					except Exception:
+						traceback.print_exc()
+						interval = self.errorInterval
+				if interval is None: break
+
+				delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+		finally:
+			if self._timers.get(key) is asyncio.current_task(): del self._timers[key]
@@ -1,91 +1,218 @@
 from discord import Member, Role, Emoji
-from typing import Dict, List, Tuple, Set
-import json
+from typing import Dict, List, Optional, Tuple, Set
+from collections import deque
+from hashlib import sha1
+import asyncio
+import time
+import gzip
+
+import codec
+
+try: import zstandard
+except ImportError: zstandard = None
+
+# Content encodings that encoded payloads can be compressed with, in order of preference
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+class MemberInfo:
+	'''
+	Compact record of the info sent about a member,
+	storing the avatar hash instead of its URL, and roles as indexes into the payload's role ID table
+	'''
+	__slots__ = ("displayName", "username", "discriminator", "avatar", "roles")
+
+	def __init__(self, displayName: str, username: str, discriminator: str, avatar: Optional[str], roles: Tuple[int, ...]):
+		self.displayName = displayName
+		self.username = username
+		self.discriminator = discriminator
+		self.avatar = avatar
+		self.roles = roles
+
+	def __eq__(self, other) -> bool:
+		return (
+			isinstance(other, MemberInfo) and
+			self.displayName == other.displayName and
+			self.username == other.username and
+			self.discriminator == other.discriminator and
+			self.avatar == other.avatar and
+			self.roles == other.roles
+		)
+
+	def avatarURL(self, id: int) -> str:
+		'''Build the avatar URL the same way discord.py's `User.avatar_url` does'''
+		if self.avatar is None: return f"https://cdn.discordapp.com/embed/avatars/{int(self.discriminator) % 5}.png"
+		return f"https://cdn.discordapp.com/avatars/{id}/{self.avatar}.{'gif' if self.avatar.startswith('a_') else 'webp'}?size=1024"
+
+	def toDict(self, id: int, roleIDs: List[str]) -> dict:
+		return {
+			"display-name": self.displayName,
+			"username": self.username,
+			"discriminator": self.discriminator,
+			"avatar": self.avatarURL(id),
+			"roles": [roleIDs[role] for role in self.roles]
+		}
+
+def roleInfo(role: Role) -> dict:
+	'''Get the info sent about a role'''
+	return {
+		"name": role.name,
+		"colour": role.colour.to_rgb()
+	}
 
 class InfoPayload:
 	'''Represents the payload to be sent on valid PATCH requests'''
-	def __init__(self):
-		self._dirty = False # Determines if the data has been modified for calls to .encode()
-		self._encoded = "" # Cached encoded data
+	def __init__(self, historySize: int = 4096):
+		self._dirty = True # Determines if the data has been modified for calls to .encode()
+		self._encoded = b"" # Cached encoded data
+		self._compressed: Dict[str, bytes] = {} # Cached encoded data as bytes, by content encoding
+		self._hash = "" # SHA-1 of the encoded payload, for ETags
 
-		self.members: Dict[str, dict] = {}
+		self.members: Dict[int, MemberInfo] = {}
 		self.roles: Dict[str, dict] = {}
 		self.emotes: Dict[str, tuple] = {}
 
 		self.constrs: Set[str] = set()
-	
-	def updateMember(self, member: Member):
-		'''Add or update a member'''
+
+		# Every change bumps the version, and is logged (up to historySize changes) so clients can request deltas
+		# (starting from the time in microseconds, so versions from before a restart are never mistaken for current ones)
+		self.version = time.time_ns() // 1000
+		self._history = deque(maxlen=historySize) # (version, section, id)
+
+		# Role IDs are interned as small integer indexes, so members don't each hold lists of role ID strings
+		self._roleIndexes: Dict[int, int] = {}
+		self._roleIDs: List[str] = []
+
+	def _memberInfo(self, member: Member) -> MemberInfo:
+		roles = []
+		for role in member.roles:
+			if role.id not in self._roleIndexes:
+				self._roleIndexes[role.id] = len(self._roleIDs)
+				self._roleIDs.append(str(role.id))
+			roles.append(self._roleIndexes[role.id])
+
+		return MemberInfo(member.display_name, member.name, member.discriminator, member.avatar, tuple(roles))
+
+	def _export(self, section: str, id) -> Optional[dict]:
+		'''Get an item in a section as it's encoded'''
+		value = getattr(self, section).get(id)
+		if section == "members" and value is not None: return value.toDict(id, self._roleIDs)
+		return value
+
+	def _set(self, section: str, id, value) -> bool:
+		'''Set (or remove if value is None) an item in a section, returns whether anything changed'''
+		items: dict = getattr(self, section)
+		if items.get(id) == value: return False
+
+		if value is None: del items[id]
+		else: items[id] = value
+
 		self._dirty = True
+		self.version += 1
+		self._history.append((self.version, section, id))
+		return True
 
-		self.members[str(member.id)] = {
-			"display-name": member.display_name,
-			"username": member.name,
-			"discriminator": member.discriminator,
-			"avatar": str(member.avatar_url),
-			"roles": [str(role.id) for role in member.roles]
-		}
-	
-	def removeMember(self, member: Member):
+	def _replace(self, section: str, values: dict) -> bool:
+		'''Replace all the items in a section, returns whether anything changed'''
+		changed = False
+		for id in [id for id in getattr(self, section) if id not in values]:
+			changed = self._set(section, id, None) or changed
+		for id, value in values.items():
+			changed = self._set(section, id, value) or changed
+		return changed
+
+	def updateMember(self, member: Member) -> bool:
+		'''Add or update a member'''
+		return self._set("members", member.id, self._memberInfo(member))
+
+	def removeMember(self, member: Member) -> bool:
 		'''Remove a member from the payload'''
-		self._dirty = True
-		del self.members[str(member.id)]
-	
-	def setMembers(self, members: List[Member]):
-		'''Set the members for the server'''
-		self._dirty = True
+		return self._set("members", member.id, None)
+
+	async def setMembers(self, members: List[Member], chunkSize: int = 1000) -> bool:
+		'''Set the members for the server, yielding to the event loop every chunkSize members'''
+		members = list(members)
+		ids = {member.id for member in members}
 
-		self.members = {}
-		for member in members: self.updateMember(member)
-	
-	def updateRole(self, role: Role):
+		changed = False
+		for id in [id for id in self.members if id not in ids]:
+			changed = self._set("members", id, None) or changed
+
+		for i in range(0, len(members), chunkSize):
+			for member in members[i:i + chunkSize]:
+				changed = self.updateMember(member) or changed
+			await asyncio.sleep(0)
+		return changed
+
+	def updateRole(self, role: Role) -> bool:
 		'''Add or update a role'''
-		self._dirty = True
+		return self._set("roles", str(role.id), roleInfo(role))
 
-		self.roles[str(role.id)] = {
-			"name": role.name,
-			"colour": role.colour.to_rgb()
-		}
-	
-	def removeRole(self, role: Role):
+	def removeRole(self, role: Role) -> bool:
 		'''Remove a role from the payload'''
-		self._dirty = True
-		del self.roles[str(role.id)]
-	
-	def setRoles(self, roles: List[Role]):
+		return self._set("roles", str(role.id), None)
+
+	def setRoles(self, roles: List[Role]) -> bool:
 		'''Set the roles for the server'''
-		self._dirty = True
+		return self._replace("roles", {str(role.id): roleInfo(role) for role in roles})
 
-		self.roles = {}
-		for role in roles: self.updateRole(role)
-	
 	# Note that emotes have no individual events, so separate update and remove methods are pointless
-	def setEmotes(self, emotes: Tuple[Emoji]):
+	def setEmotes(self, emotes: Tuple[Emoji]) -> bool:
 		'''Set the emotes for the server'''
-		self._dirty = True
+		return self._replace("emotes", {str(emote.id): {
+			"name": emote.name,
+			"url": str(emote.url)
+		} for emote in emotes})
 
-		self.emotes = {}
-		for emote in emotes:
-			self.emotes[str(emote.id)] = {
-				"name": emote.name,
-				"url": str(emote.url)
-			}
-	
 	def addConStr(self, constr: str):
 		'''Add a connection string that this info payload is being used with'''
 		self.constrs.add(constr)
-	
+
 	def removeConStr(self, constr: str):
 		'''Remove a connection string that this info payload was being used with'''
 		self.constrs.remove(constr)
-	
-	def encode(self) -> str:
+
+	def encode(self) -> bytes:
 		'''Encode the payload as JSON (caches the result for later)'''
 		if self._dirty:
-			self._encoded = json.dumps({
-				"members": self.members,
+			self._encoded = codec.dumps({
+				"version": self.version,
+				"members": {id: member.toDict(id, self._roleIDs) for id, member in self.members.items()},
 				"roles": self.roles,
 				"emotes": self.emotes
 			})
+			self._compressed = {}
+			self._hash = sha1(self._encoded).hexdigest()
 			self._dirty = False
 		return self._encoded
+
+	def etag(self, encoding: str = "identity") -> str:
+		'''Get a strong ETag for the encoded payload as sent with a content encoding (each encoding is a different representation, so has its own)'''
+		self.encode()
+		return f'"{self._hash}"' if encoding == "identity" else f'"{self._hash}-{encoding}"'
+
+	def encodeAs(self, encoding: str = "identity") -> bytes:
+		'''Get the encoded payload as bytes, compressed with one of `ENCODINGS` unless identity (caches the result for later)'''
+		encoded = self.encode()
+		if encoding not in self._compressed:
+			if encoding == "identity": self._compressed[encoding] = encoded
+			elif encoding == "gzip": self._compressed[encoding] = gzip.compress(encoded, 6)
+			elif encoding == "zstd" and zstandard is not None: self._compressed[encoding] = zstandard.ZstdCompressor().compress(encoded)
+			else: raise ValueError(f"Unsupported content encoding {encoding}")
+		return self._compressed[encoding]
+
+	def encodeDelta(self, since: int) -> Optional[bytes]:
+		'''
+		Encode only what changed after the given version as JSON (removed items are null),
+		returns None if the changes are no longer in the history and a full payload is needed
+		'''
+		if since > self.version: return None
+		if since != self.version and (len(self._history) == 0 or self._history[0][0] > since + 1): return None
+
+		delta = {"members": {}, "roles": {}, "emotes": {}}
+		for version, section, id in reversed(self._history):
+			if version <= since: break
+			delta[section][id] = self._export(section, id)
+
+		delta["version"] = self.version
+		delta["delta"] = True
+		return codec.dumps(delta)
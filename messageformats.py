@@ -0,0 +1,96 @@
+from typing import Dict, List, Tuple
+import json
+import os
+import random
+import re
+import time
+
+from discord.utils import escape_markdown
+
+# Formats used for any category that's missing or empty in the file
+DEFAULT_FORMATS = {
+	"joinMsgs": ["`{player}` just joined the server!"],
+	"leaveMsgs": ["`{player}` just left the server"],
+	"suicide": ["`{victim}` killed themselves with `{inflictor}`"],
+	"suicideNoWeapon": ["`{victim}` killed themselves"],
+	"kill": ["`{attacker}` killed `{victim}` with `{inflictor}`"],
+	"killNoWeapon": ["`{attacker}` killed `{victim}`"]
+}
+
+FIELD_PATTERN = re.compile(r"\{(\w+)\}")
+
+def escapeCode(value: str) -> str:
+	'''Stop a value from closing the inline code span it's in (backslashes don't work in code, so backticks are swapped for a lookalike)'''
+	return value.replace("`", "ˋ")
+
+class Template:
+	'''
+	A message format compiled into its literal text and fields, so it can be rendered in a single pass.
+	Values are escaped for where each field is, markdown outside inline code and backticks inside it.
+	'''
+	__slots__ = ("segments",)
+
+	def __init__(self, format: str):
+		self.segments: List[Tuple[bool, str, bool]] = [] # (whether it's a field, literal text or field name, whether it's inside inline code)
+
+		position = 0
+		for match in FIELD_PATTERN.finditer(format):
+			if match.start() != position: self.segments.append((False, format[position:match.start()], False))
+			self.segments.append((True, match.group(1), format.count("`", 0, match.start()) % 2 == 1))
+			position = match.end()
+		if position != len(format): self.segments.append((False, format[position:], False))
+
+	def render(self, values: Dict[str, str]) -> str:
+		'''Fill in the fields (any not given are left as they are)'''
+		parts = []
+		for isField, text, inCode in self.segments:
+			if not isField: parts.append(text)
+			elif text not in values: parts.append("{" + text + "}")
+			else: parts.append(escapeCode(values[text]) if inCode else escape_markdown(values[text]))
+		return "".join(parts)
+
+class MessageFormats:
+	'''
+	The message formats from messageFormats.json, compiled into templates.
+	The file is reloaded when it changes (checked at most every checkInterval seconds), so formats can be edited without a restart.
+	'''
+	def __init__(self, path: str, checkInterval: float = 5):
+		self.path = path
+		self.checkInterval = checkInterval
+
+		self.templates: Dict[str, List[Template]] = {}
+		self._mtime = None
+		self._nextCheck = 0
+
+		self.load()
+
+	def load(self):
+		'''Load and compile the formats (keeping the current ones if the file is invalid)'''
+		mtime = os.stat(self.path).st_mtime_ns
+		try:
+			with open(self.path, "r") as f: formats = json.load(f)
+		except ValueError as e:
+			if self._mtime is None: raise
+			print(f"Failed to reload {self.path}, keeping the current message formats: {e}")
+			formats = None
+		self._mtime = mtime
+
+		if formats is None: return
+		self.templates = {
+			category: [Template(format) for format in (formats.get(category) or defaults)]
+			for category, defaults in DEFAULT_FORMATS.items()
+		}
+
+	def reloadIfChanged(self):
+		'''Reload the formats if the file has been modified since they were loaded'''
+		now = time.monotonic()
+		if now < self._nextCheck: return
+		self._nextCheck = now + self.checkInterval
+
+		try: mtime = os.stat(self.path).st_mtime_ns
+		except OSError: return # File is being replaced, try again later
+		if mtime != self._mtime: self.load()
+
+	def render(self, category: str, **values: str) -> str:
+		'''Render a random format from a category'''
+		return random.choice(self.templates[category]).render(values)
@@ -1,5 +1,8 @@
+import asyncio
 import re
-from typing import List
+from typing import List, Optional
+
+from query import QueryClient, udpProbe
 
 class Info:
 	'''Server info struct'''
@@ -19,6 +22,9 @@ class NanosError(Exception):
 		self.rawMessage = message
 		super().__init__(self.message)
 
+# Shared by every server, so the cache covers all of them (replace to change the timeout, retries or TTL)
+queryClient = QueryClient()
+
 # Super long regex that validates a string is a valid ip, then :, then a valid port number
 CONSTR_REGEX = re.compile(r"^(?:(?:[0-9]|[0-9][0-9]|1[0-9][0-9]|2[0-4][0-9]|25[0-5])\.){3}(?:[0-9]|[0-9][0-9]|1[0-9][0-9]|2[0-4][0-9]|25[0-5]):(?:[1-9]|[1-9][0-9]|[1-9][0-9][0-9]|[1-9][0-9][0-9][0-9]|[0-5][0-9][0-9][0-9][0-9]|6[0-4][0-9][0-9][0-9]|65[0-4][0-9][0-9]|655[0-2][0-9]|6553[0-5])$")
 class NanosServer:
@@ -31,28 +37,34 @@ class NanosServer:
 		self._port = int(self._port)
 
 		self.isClosed = False
+		self.lastInfo = Info("Nanos World Server") # Info from the last successful query, for when the server is down (or can't be queried)
 
 	def retry(self):
 		self.isClosed = False
 
 	def close(self):
 		self.isClosed = True
+		queryClient.invalidate(self._ip, self._port) # So a retry queries it again
 
 	def getConstring(self) -> str:
 		'''Get server connection string'''
 		return self._constring
+
+	async def _query(self, kind: str, probe):
+		try: return await queryClient.query(kind, self._ip, self._port, probe)
+		except asyncio.TimeoutError: raise NanosError(self, f"{kind} query timed out")
+		except OSError as e: raise NanosError(self, f"{kind} query failed, {e.strerror or e}")
 	
-	def ping(self, places: int = 0) -> float:
-		'''Gets server ping from the bot'''
-		#sendTime = time.time()
-		#_ = self.info
-		#return round((time.time() - sendTime) * 1000, places)
-		return -1
-
-	def getInfo(self) -> Info:
+	async def ping(self, places: int = 0) -> Optional[float]:
+		'''Gets server ping from the bot, None if the server didn't answer (which doesn't mean it's down, see udpProbe)'''
+		ping = await self._query("ping", udpProbe)
+		return None if ping is None else round(ping, places)
+
+	# Nanos World doesn't document a query protocol for server info or players, so until it does neither is available
+	async def getInfo(self) -> Info:
 		'''Get server info'''
-		return Info("Nanos World Server")
+		raise NanosError(self, "server info isn't available, Nanos World has no documented query protocol")
 
-	def getPlayers(self) -> List[Player]:
+	async def getPlayers(self) -> List[Player]:
 		'''Get players on server'''
-		return []
+		raise NanosError(self, "player lists aren't available, Nanos World has no documented query protocol")
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Dict, Iterable, List, Set, Tuple
+
+import discord
+
+from dispatcher import ALERT, Dispatcher
+from persistence import DataStore
+from registry import Connection
+
+class Notifier:
+	'''
+	Sends outage notifications to the people set to be notified about a connection's server.
+	Members are resolved from the gateway cache where possible, with the rest queried in batches,
+	DMs are sent concurrently (up to maxConcurrent at once, discord.py waits out any rate limits),
+	and anyone who's left the guild or can't be DMed is removed from the connection's list.
+	'''
+	def __init__(self, store: DataStore, dispatcher: Dispatcher, maxConcurrent: int = 5, batchSize: int = 100):
+		self.store = store
+		self.dispatcher = dispatcher # DMs take the dispatcher's job slots as alerts, so they give way to chat but not game events
+		self.batchSize = batchSize # Max user IDs per member query (Discord's limit is 100)
+
+		self._semaphore = asyncio.Semaphore(maxConcurrent)
+
+	async def resolve(self, connection: Connection, guild: discord.Guild) -> List[discord.Member]:
+		'''Get the members set to be notified about a connection's server, removing anyone who's no longer in the guild'''
+		members, missing = await self._resolve(guild, connection.toNotify)
+		self._prune(connection, missing)
+		return [members[id] for id in connection.toNotify if id in members]
+
+	async def notify(self, connection: Connection, guild: discord.Guild, message: str):
+		'''DM everyone set to be notified about a connection's server'''
+		members, undeliverable = await self._resolve(guild, connection.toNotify)
+		content = f"{message}\n*You are receiving this message as you are set to be notified regarding server outage at `{guild.name}`*"
+
+		async def send(member: discord.Member):
+			async with self._semaphore, self.dispatcher.slot(ALERT):
+				try: await member.send(content)
+				except discord.Forbidden: undeliverable.add(member.id) # DMs from the bot are blocked
+				except discord.HTTPException as e: print(f"Failed to notify {member.id} about {connection.constring}: {e}")
+
+		await asyncio.gather(*(send(member) for member in members.values()))
+		self._prune(connection, undeliverable)
+
+	async def _resolve(self, guild: discord.Guild, ids: Iterable[int]) -> Tuple[Dict[int, discord.Member], Set[int]]:
+		'''Look up members by ID, returns those found and the IDs of those that aren't in the guild'''
+		members = {}
+		uncached = []
+		for id in ids:
+			member = guild.get_member(id)
+			if member is None: uncached.append(id)
+			else: members[id] = member
+
+		async def query(batch: List[int]) -> Set[int]:
+			async with self._semaphore:
+				try: found = await guild.query_members(user_ids=batch, limit=len(batch), cache=True)
+				except asyncio.TimeoutError: return set() # Unknown, so nobody is removed
+			for member in found: members[member.id] = member
+			return set(batch) - {member.id for member in found}
+
+		missing = set()
+		for notFound in await asyncio.gather(*(query(uncached[i:i + self.batchSize]) for i in range(0, len(uncached), self.batchSize))):
+			missing |= notFound
+		return members, missing
+
+	def _prune(self, connection: Connection, ids: Set[int]):
+		'''Remove IDs from a connection's notify list (keeping anyone added while they were being resolved)'''
+		if len(ids) == 0: return
+		connection.toNotify = [id for id in connection.toNotify if id not in ids]
+		self.store.record(connection.channelID)
@@ -0,0 +1,83 @@
+from typing import Dict
+import json
+import os
+
+from nanosserver import NanosServer
+from registry import Connection, Registry
+
+def serialiseConnection(connection: Connection) -> dict:
+	'''Convert a channel's connection to what's stored on disk'''
+	return {
+		"server": connection.constring,
+		"toNotify": connection.toNotify,
+		"time_since_down": connection.timeSinceDown,
+		"relay": 1 if connection.relay else 0,
+		"aggregation": connection.aggregation
+	}
+
+def deserialiseConnection(channelID: str, data: dict) -> Connection:
+	'''Convert a channel's connection from what's stored on disk'''
+	return Connection(int(channelID), NanosServer(data["server"]), list(data["toNotify"]), data["relay"] == 1, aggregation=data.get("aggregation"))
+
+class DataStore:
+	'''
+	Persists the connection of each channel.
+	Every change is appended to a journal, which is periodically compacted into the data file (replaced atomically).
+	'''
+	def __init__(self, path: str, compactEvery: int = 100):
+		self.path = path
+		self.journalPath = path + ".journal"
+		self.compactEvery = compactEvery
+
+		self.registry = Registry()
+		self._journal = None
+		self._journalLength = 0
+
+	def load(self) -> Registry:
+		'''Load the data file and replay any changes journaled since it was written'''
+		data: Dict[str, dict] = {}
+		if os.path.exists(self.path):
+			with open(self.path, "r") as f: data = json.load(f)
+
+		if os.path.exists(self.journalPath):
+			with open(self.journalPath, "r") as f:
+				for line in f:
+					try: change = json.loads(line)
+					except ValueError: break # Incomplete write from a crash, nothing after it was committed
+
+					if change["connection"] is None: data.pop(change["channel"], None)
+					else: data[change["channel"]] = change["connection"]
+					self._journalLength += 1
+
+		for channelID, connectionData in data.items():
+			self.registry.add(deserialiseConnection(channelID, connectionData))
+
+		self._journal = open(self.journalPath, "a")
+		return self.registry
+
+	def record(self, channelID: int):
+		'''Journal the current state of a channel's connection (call after every change to it)'''
+		connection = self.registry.get(channelID)
+		self._journal.write(json.dumps({
+			"channel": str(channelID),
+			"connection": None if connection is None else serialiseConnection(connection)
+		}) + "\n")
+		self._journal.flush()
+		os.fsync(self._journal.fileno())
+
+		self._journalLength += 1
+		if self._journalLength >= self.compactEvery: self.compact()
+
+	def compact(self):
+		'''Write all the data to the data file, and clear the journal'''
+		tempPath = self.path + ".tmp"
+		with open(tempPath, "w") as f:
+			json.dump({str(connection.channelID): serialiseConnection(connection) for connection in self.registry}, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tempPath, self.path)
+
+		# If this is interrupted the journal is just replayed over the new data file, which is harmless
+		if self._journal is not None: self._journal.close()
+		self._journal = open(self.journalPath, "w")
+		self._journalLength = 0
@@ -0,0 +1,91 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import time
+
+# A probe queries a server at (host, port), given a timeout in seconds that it should stop waiting for answers after
+Probe = Callable[[str, int, float], Awaitable[Any]]
+
+class _ProbeProtocol(asyncio.DatagramProtocol):
+	def __init__(self, answer: asyncio.Future):
+		self.answer = answer
+
+	def datagram_received(self, data: bytes, addr):
+		if not self.answer.done(): self.answer.set_result(None)
+
+	def error_received(self, exc: Exception):
+		if not self.answer.done(): self.answer.set_exception(exc)
+
+async def udpProbe(host: str, port: int, timeout: float) -> Optional[float]:
+	'''
+	Send a one byte datagram to a server's (UDP) game port, and time how long the server takes to answer it, in milliseconds.
+	Fails if the host reports the port closed (the server isn't running) or itself unreachable.
+	Nanos World doesn't document a query protocol, so a running server is free to ignore the datagram, and None is returned if nothing answers.
+	That can't tell a running server from a host that's gone, so None isn't proof either way.
+	'''
+	loop = asyncio.get_running_loop()
+	answer = loop.create_future()
+	transport, _ = await loop.create_datagram_endpoint(lambda: _ProbeProtocol(answer), remote_addr=(host, port))
+	try:
+		start = time.perf_counter()
+		transport.sendto(b"\0")
+		try: await asyncio.wait_for(answer, timeout)
+		except asyncio.TimeoutError: return None
+		return (time.perf_counter() - start) * 1000
+	finally: transport.close()
+
+class QueryClient:
+	'''
+	Runs server queries without blocking the event loop, with a timeout and retries for each.
+	Results (including failures) are cached for ttl seconds, and identical queries already in flight are shared,
+	so repeated commands don't each hit the server.
+	'''
+	def __init__(self, timeout: float = 2, retries: int = 2, ttl: float = 5):
+		self.timeout = timeout
+		self.retries = retries
+		self.ttl = ttl
+
+		self._cache: Dict[Tuple[str, str, int], Tuple[float, Any, bool]] = {} # (expiry, result or exception, whether it failed)
+		self._inFlight: Dict[Tuple[str, str, int], asyncio.Future] = {}
+
+	async def query(self, kind: str, host: str, port: int, probe: Probe):
+		'''Run a probe against a server, or get its cached result if it was run within the TTL'''
+		key = (kind, host, port)
+
+		cached = self._cache.get(key)
+		if cached is not None and cached[0] > time.monotonic():
+			if cached[2]: raise cached[1]
+			return cached[1]
+
+		if key in self._inFlight: return await asyncio.shield(self._inFlight[key])
+
+		future = asyncio.get_event_loop().create_future()
+		self._inFlight[key] = future
+		try:
+			result = await self._run(host, port, probe)
+		except asyncio.CancelledError:
+			future.cancel()
+			raise
+		except (OSError, asyncio.TimeoutError) as e:
+			self._cache[key] = (time.monotonic() + self.ttl, e, True)
+			future.set_exception(e)
+			future.exception() # Mark as retrieved, there may be nothing else waiting on it
+			raise
+		else:
+			self._cache[key] = (time.monotonic() + self.ttl, result, False)
+			future.set_result(result)
+			return result
+		finally:
+			del self._inFlight[key]
+
+	async def _run(self, host: str, port: int, probe: Probe):
+		for attempt in range(self.retries + 1):
+			# Probes handle their own timeout (silence can be an answer), this only cuts off one that hangs
+			try: return await asyncio.wait_for(probe(host, port, self.timeout), self.timeout * 2)
+			except (OSError, asyncio.TimeoutError):
+				if attempt == self.retries: raise
+				await asyncio.sleep(0.1 * 2 ** attempt)
+
+	def invalidate(self, host: str, port: int):
+		'''Forget the cached results for a server'''
+		for key in [key for key in self._cache if key[1] == host and key[2] == port]:
+			del self._cache[key]
@@ -0,0 +1,119 @@
+from typing import Dict, Iterator, List, Optional, Set
+
+from nanosserver import NanosServer
+
+class Connection:
+	'''A channel's connection to a server'''
+	__slots__ = ("channelID", "guildID", "server", "toNotify", "timeSinceDown", "relay", "aggregation", "active")
+
+	def __init__(
+		self, channelID: int, server: NanosServer, toNotify: Optional[List[int]] = None, relay: bool = False, guildID: Optional[int] = None,
+		aggregation: Optional[Dict[str, float]] = None
+	):
+		self.channelID = channelID
+		self.guildID = guildID # None until the channel has been seen (e.g. connections loaded before the bot is ready)
+		self.server = server
+		self.toNotify = toNotify if toNotify is not None else []
+		self.timeSinceDown = -1
+		self.relay = relay
+		self.aggregation = aggregation if aggregation is not None else {} # Event aggregation settings set for this channel (see aggregation.py)
+		self.active = False # Whether this connection is relaying (relay enabled and server open), maintained by the registry
+
+	@property
+	def constring(self) -> str:
+		return self.server.getConstring()
+
+class Registry:
+	'''
+	Every channel's connection, indexed by channel ID and guild ID.
+	Also tracks the active relays by constring, so hot paths only look at connections that are actually relaying.
+	Changes to a connection's relay or server state must go through the registry to keep the indexes up to date.
+	'''
+	def __init__(self):
+		self._byChannel: Dict[int, Connection] = {}
+		self._byGuild: Dict[int, Set[int]] = {}
+
+		self.active: Dict[str, Connection] = {} # Active relays by constring (at most one channel can relay a server)
+		self.activeChannels: Set[int] = set() # IDs of the channels with active relays, for rejecting messages from other channels quickly
+
+	def __len__(self) -> int:
+		return len(self._byChannel)
+
+	def __contains__(self, channelID: int) -> bool:
+		return channelID in self._byChannel
+
+	def __iter__(self) -> Iterator[Connection]:
+		return iter(tuple(self._byChannel.values())) # Copied, so connections can be added and removed while iterating
+
+	def get(self, channelID: int) -> Optional[Connection]:
+		return self._byChannel.get(channelID)
+
+	def inGuild(self, guildID: int) -> List[Connection]:
+		'''Get the connections of channels in a guild'''
+		return [self._byChannel[channelID] for channelID in self._byGuild.get(guildID, ())]
+
+	def activeInGuild(self, guildID: int) -> bool:
+		'''Whether any channel in a guild has an active relay'''
+		return any(connection.active for connection in self.inGuild(guildID))
+
+	def add(self, connection: Connection):
+		'''Add a channel's connection (replacing any existing one)'''
+		self.remove(connection.channelID)
+
+		self._byChannel[connection.channelID] = connection
+		if connection.guildID is not None: self._byGuild.setdefault(connection.guildID, set()).add(connection.channelID)
+		self._updateActive(connection)
+
+	def remove(self, channelID: int) -> Optional[Connection]:
+		'''Remove a channel's connection, returns it if there was one'''
+		connection = self._byChannel.pop(channelID, None)
+		if connection is None: return None
+
+		if connection.guildID is not None: self._discard(self._byGuild, connection.guildID, channelID)
+		if connection.active:
+			del self.active[connection.constring]
+			self.activeChannels.discard(channelID)
+			connection.active = False
+		return connection
+
+	def setGuild(self, connection: Connection, guildID: int):
+		'''Set the guild a connection's channel is in'''
+		if connection.guildID == guildID: return
+		if connection.guildID is not None: self._discard(self._byGuild, connection.guildID, connection.channelID)
+		connection.guildID = guildID
+		self._byGuild.setdefault(guildID, set()).add(connection.channelID)
+
+	def setRelay(self, connection: Connection, enabled: bool):
+		'''Enable or disable the relay for a connection'''
+		connection.relay = enabled
+		self._updateActive(connection)
+
+	def close(self, connection: Connection):
+		'''Close a connection's server'''
+		connection.server.close()
+		self._updateActive(connection)
+
+	def retry(self, connection: Connection):
+		'''Attempt to reopen a connection's server'''
+		connection.server.retry()
+		self._updateActive(connection)
+
+	def _updateActive(self, connection: Connection):
+		if connection.channelID not in self._byChannel: return
+
+		shouldBeActive = connection.relay and not connection.server.isClosed
+		if shouldBeActive and not connection.active and connection.constring not in self.active:
+			self.active[connection.constring] = connection
+			self.activeChannels.add(connection.channelID)
+			connection.active = True
+		elif not shouldBeActive and connection.active:
+			del self.active[connection.constring]
+			self.activeChannels.discard(connection.channelID)
+			connection.active = False
+
+	@staticmethod
+	def _discard(index: Dict, key, channelID: int):
+		channels = index.get(key)
+		if channels is None: return
+		channels.discard(channelID)
+		if len(channels) == 0: del index[key]
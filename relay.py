@@ -1,20 +1,70 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.client import HTTPMessage, parse_headers
+from http import HTTPStatus
 from socketserver import ThreadingMixIn
-from threading import Thread
+from threading import Thread, Lock
+from contextlib import nullcontext
+from typing import Dict, Optional, Tuple
+import asyncio
 import atexit
-import json
-from time import sleep
-import requests
-import re
+import io
+import traceback
+from time import sleep, monotonic
 import socket
 
-infoPayloads = {}
+from avatars import AvatarResolver, AvatarStore
+from infopayload import InfoPayload, ENCODINGS
+from boundedqueue import BoundedQueue, DROP_NEWEST, POLICIES, SUMMARISE
+from durablequeue import DurableLog
+import codec
+
+infoPayloads: Dict[str, Optional[InfoPayload]] = {}
 payloadDirty = {}
 
-discordMsgs = {}
-sourceMsgs = {}
+discordMsgs: Dict[str, Dict[str, BoundedQueue]] = {}
+sourceMsgs: Dict[str, Dict[str, BoundedQueue]] = {}
+
+# Max number of queued items per constring for each category, and what to do once that's reached
+queueLimits = {"chat": 1000, "rcon": 100, "joins": 500, "leaves": 500, "deaths": 1000, "custom": 500}
+overflowPolicy = SUMMARISE
+
+# Optional write-ahead log of everything queued, so messages survive a restart
+journal: Optional[DurableLog] = None
+# Journal IDs of source messages taken by the consumer but not yet acknowledged as delivered
+unacked: Dict[str, list] = {}
+
+# How summaries of discarded items are worded
+OVERFLOW_NOUNS = {"chat": "messages", "joins": "joins", "leaves": "leaves", "deaths": "deaths", "custom": "events"}
+
+# Constrings that have received source messages since the consumer last checked, and the event to wake it
+readySources = set()
+readyEvent = asyncio.Event()
+# Set when a constring has new discord messages (or a dirty info payload), to wake long-polling GETs
+discordEvents: Dict[str, asyncio.Event] = {}
+
+# When each relayed server last made a request (or its relay was added, as a grace period), monotonic time, a free heartbeat for health checks.
+# Kept once a relay is removed, so a closed server that's still polling can be seen to be back up
+lastSeen: Dict[str, float] = {}
+
+# Guards queue appends and swaps, only needed when requests are served from the threaded engine
+queueLock = nullcontext()
+threadedEngine = False
+eventLoop: Optional[asyncio.AbstractEventLoop] = None
+
+# Looks up the avatars of chat messages sent without an icon, so they're ready by the time the message is relayed
+avatars = AvatarResolver()
 
-avatarPattern = re.compile(r"<avatarIcon><!\[CDATA\[(.*?)\]\]></avatarIcon>")
+# String params each type of source server event must have (relaying an event without them would fail on the bot's side)
+EVENT_FIELDS = {
+	"message": ("name", "teamName", "teamColour", "steamID", "message"),
+	"join": ("name",),
+	"leave": ("name",),
+	"death": ("victim", "inflictor", "attacker", "suicide", "noweapon"),
+	"custom": ("body",)
+}
+
+# Status code, headers, body
+Response = Tuple[int, Dict[str, str], bytes]
 
 # https://stackoverflow.com/a/28950776
 def get_ip():
@@ -30,6 +80,182 @@ def get_ip():
 		s.close()
 	return IP
 
+def getConstring(host: str, headers: HTTPMessage) -> str:
+	'''Build the constring of the game server that made a request'''
+	return f"{host if host != '127.0.0.1' else get_ip()}:{headers['Source-Port']}"
+
+def onLoop(callback, *args):
+	'''Run a callback on the bot's event loop (directly unless called from the threaded engine)'''
+	if threadedEngine and eventLoop is not None: eventLoop.call_soon_threadsafe(callback, *args)
+	else: callback(*args)
+
+def callOnLoop(callback, *args):
+	'''Run a callback on the bot's event loop from one of the threaded engine's request threads, and wait for its result (directly if the loop isn't bound yet)'''
+	if eventLoop is None: return callback(*args)
+
+	async def call(): return callback(*args)
+	return asyncio.run_coroutine_threadsafe(call(), eventLoop).result()
+
+def signal(events: Dict[str, asyncio.Event], constring: str):
+	'''Wake anything awaiting the given event for this constring'''
+	event = events.get(constring)
+	if event is not None: onLoop(event.set)
+
+def markSourceReady(constring: str):
+	'''Flag a constring as having source messages and wake the consumer (must run on the event loop)'''
+	if constring not in sourceMsgs: return # Relay was removed before this ran
+	readySources.add(constring)
+	readyEvent.set()
+
+class RequestError(Exception):
+	'''Raised to abort a request with an error response'''
+	def __init__(self, status: int, explain: str = ""):
+		if len(explain) != 0: print(explain)
+		self.response: Response = (status, {}, bytes(explain, encoding="utf-8"))
+		super().__init__(explain)
+
+def enqueue(queues: Dict[str, BoundedQueue], constring: str, direction: str, category: str, item):
+	'''Add an item to one of a constring's queues, logging it if the journal is enabled (call with queueLock held)'''
+	id = None if journal is None else journal.append(constring, direction, category, item)
+	discarded = queues[category].append(item, id)
+	if discarded is not None: journal.ack((discarded,))
+
+def requestConstring(host: str, headers: HTTPMessage, queues: dict) -> str:
+	'''Get the constring of a request, validating that it's being relayed'''
+	if "Source-Port" not in headers: raise RequestError(400)
+
+	constring = getConstring(host, headers)
+	if constring in queues or constring in lastSeen: lastSeen[constring] = monotonic()
+	if constring not in queues: raise RequestError(403)
+	return constring
+
+def handleGet(host: str, headers: HTTPMessage) -> Response:
+	'''The "transmitter" for discord chat (and any flags)'''
+	try: constring = requestConstring(host, headers, discordMsgs)
+	except RequestError as e: return e.response
+
+	with queueLock:
+		queues = discordMsgs[constring]
+		msgs = {}
+		for category in ("chat", "rcon"):
+			msgs[category], ids = queues[category].drainWithKeys()
+			if journal is not None: journal.ack(ids)
+		if constring in discordEvents: discordEvents[constring].clear()
+
+		skipped = queues["chat"].takeSkipped()
+		if skipped != 0:
+			summary = f"…and {skipped} more {OVERFLOW_NOUNS['chat']}"
+			msgs["chat"].append(("Relay", summary, "ffffff", "", summary))
+
+	mimeType = codec.negotiate(headers)
+	return (200, {"Content-type": mimeType}, codec.encode({
+		"messages": msgs,
+		"init-info-dirty": payloadDirty[constring]
+	}, mimeType))
+
+def hasDiscordData(constring: str) -> bool:
+	'''Whether a GET for this constring would currently return anything'''
+	queues = discordMsgs[constring]
+	return len(queues["chat"]) != 0 or len(queues["rcon"]) != 0 or payloadDirty[constring]
+
+def getPollTimeout(headers: HTTPMessage, maxTimeout: float) -> float:
+	'''Get the time in seconds a GET may be held open for, as requested with the Poll-Timeout header'''
+	try: timeout = float(headers.get("Poll-Timeout", 0))
+	except ValueError: return 0
+	return max(0, min(timeout, maxTimeout))
+
+def parsePost(host: str, headers: HTTPMessage, body: bytes) -> Tuple[str, dict]:
+	'''Validate a POST from a source server, returning its constring and decoded events'''
+	constring = requestConstring(host, headers, sourceMsgs)
+
+	mimeType = codec.getMimeType(headers.get("Content-type", ""))
+	if mimeType not in codec.MIME_TYPES:
+		raise RequestError(400, f"Request MIME type of {headers['Content-type']} is invalid")
+
+	try: data = codec.decode(body, mimeType)
+	except ValueError: raise RequestError(400, f"Request body is not valid {mimeType}")
+
+	if not isinstance(data, dict): raise RequestError(400, "Request body is not an object")
+	for k in data:
+		if not isinstance(data[k], dict): raise RequestError(400, "Request event is not an object")
+		if "type" not in data[k].keys(): raise RequestError(400, "Request type param was not present")
+		if not isinstance(data[k]["type"], str) or data[k]["type"] not in EVENT_FIELDS:
+			raise RequestError(400, f"Request type param was not valid, got {data[k]['type']}")
+
+		missing = [field for field in EVENT_FIELDS[data[k]["type"]] if not isinstance(data[k].get(field), str)]
+		if len(missing) != 0: raise RequestError(400, f"Request {data[k]['type']} event is missing (or has non-string) " + ", ".join(missing))
+	return constring, data
+
+def queuePost(constring: str, data: dict):
+	'''Add decoded source server events to the queues'''
+	if constring not in sourceMsgs: return # Relay was removed while the request was being handled
+
+	with queueLock:
+		queues = sourceMsgs[constring]
+		for k in sorted(data):
+			if data[k]["type"] == "message":
+				enqueue(queues, constring, "source", "chat", data[k])
+			elif data[k]["type"] == "join":
+				enqueue(queues, constring, "source", "joins", data[k]["name"])
+			elif data[k]["type"] == "leave":
+				enqueue(queues, constring, "source", "leaves", data[k]["name"])
+			elif data[k]["type"] == "death":
+				enqueue(queues, constring, "source", "deaths", (data[k]["victim"], data[k]["inflictor"], data[k]["attacker"], data[k]["suicide"] == "1", data[k]["noweapon"] == "1"))
+			elif data[k]["type"] == "custom":
+				enqueue(queues, constring, "source", "custom", data[k]["body"])
+
+	if len(data) != 0: onLoop(markSourceReady, constring)
+
+def handlePost(host: str, headers: HTTPMessage, body: bytes) -> Response:
+	'''The "receiver" for source server chat'''
+	try: constring, data = parsePost(host, headers, body)
+	except RequestError as e: return e.response
+
+	queuePost(constring, data)
+
+	# Avatars are looked up on the bot's event loop, so requests that arrive before it's running go without (they're looked up when relayed instead)
+	if eventLoop is not None:
+		for event in data.values():
+			if event["type"] == "message" and "icon" not in event: onLoop(avatars.prefetch, event["steamID"])
+	return (200, {}, b"")
+
+def handlePatch(host: str, headers: HTTPMessage) -> Response:
+	'''Request to get the info payload (must run on the event loop, where the payload is changed)'''
+	try: constring = requestConstring(host, headers, sourceMsgs)
+	except RequestError as e: return e.response
+
+	payloadDirty[constring] = False
+
+	payload = infoPayloads[constring]
+	if payload is None: return (200, {}, b"")
+
+	# Clients that send the version they have only get what's changed since, if it's still in the history
+	if "Payload-Version" in headers:
+		try: delta = payload.encodeDelta(int(headers["Payload-Version"]))
+		except ValueError: delta = None
+		if delta is not None: return (200, {"Content-type": codec.JSON}, delta)
+
+	# Full payloads are only sent if the client doesn't already have them, compressed if it accepts it
+	encoding = getContentEncoding(headers)
+	etag = payload.etag(encoding)
+	if etag in [tag.strip() for tag in headers.get("If-None-Match", "").split(",")]: return (304, {"ETag": etag, "Vary": "Accept-Encoding"}, b"")
+
+	responseHeaders = {"Content-type": codec.JSON, "ETag": etag, "Vary": "Accept-Encoding"}
+	if encoding != "identity": responseHeaders["Content-Encoding"] = encoding
+	return (200, responseHeaders, payload.encodeAs(encoding))
+
+def getContentEncoding(headers: HTTPMessage) -> str:
+	'''Get the preferred content encoding accepted by a request'''
+	accepted = set()
+	for value in headers.get("Accept-Encoding", "").split(","):
+		encoding, _, params = value.partition(";")
+		if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"): continue
+		accepted.add(encoding.strip().lower())
+
+	for encoding in ENCODINGS:
+		if encoding in accepted: return encoding
+	return "identity"
+
 def relayThread(port):
 	def onExit(filepath: str):
 		print("Relay thread shutdown")
@@ -49,157 +275,338 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
 	pass
 
 class Handler(BaseHTTPRequestHandler):
-	def do_GET(self):
-		'''The "transmitter" for discord chat (and any flags)'''
-		if "Source-Port" not in self.headers:
-			self.send_response(400)
-			self.end_headers()
-			return
-
-		constring = f"{self.client_address[0] if self.client_address[0] != '127.0.0.1' else get_ip()}:{self.headers['Source-Port']}"
-		if constring not in discordMsgs:
-			self.send_response(403)
-			self.end_headers()
-			return
-
-		self.send_response(200)
-		self.send_header("Content-type", "application/json")
+	def respond(self, response: Response):
+		status, headers, body = response
+		self.send_response(status)
+		for header, value in headers.items(): self.send_header(header, value)
+		self.send_header("Content-Length", str(len(body)))
 		self.end_headers()
+		if len(body) != 0: self.wfile.write(body)
 
-		self.wfile.write(bytes(json.dumps({
-			"messages": discordMsgs[constring],
-			"init-info-dirty": payloadDirty[constring]
-		}), encoding="utf-8"))	
-		discordMsgs[constring] = {"chat": [], "rcon": []}
+	def do_GET(self):
+		self.respond(handleGet(self.client_address[0], self.headers))
 
 	def do_POST(self):
-		'''The "receiver" for source server chat'''
-		if "Source-Port" not in self.headers:
-			self.send_response(400)
-			self.end_headers()
-			return
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		self.respond(handlePost(self.client_address[0], self.headers, body))
 
-		constring = f"{self.client_address[0] if self.client_address[0] != '127.0.0.1' else get_ip()}:{self.headers['Source-Port']}"
-		if constring not in sourceMsgs:
-			self.send_response(403)
-			self.end_headers()
+	def do_PATCH(self):
+		# Info payloads are changed on the event loop, so they're encoded there too (encoding from this thread could see them mid-change)
+		self.respond(callOnLoop(handlePatch, self.client_address[0], self.headers))
+
+class AsyncRelayServer(object):
+	'''HTTP/1.1 relay server with keep-alive, served from an asyncio event loop'''
+
+	def __init__(self, port: int, keepAliveTimeout: float = 60, maxPollTimeout: float = 30):
+		self.port = port
+		self.keepAliveTimeout = keepAliveTimeout
+		self.maxPollTimeout = maxPollTimeout
+		self._server: Optional[asyncio.AbstractServer] = None
+
+	async def start(self):
+		self._server = await asyncio.start_server(self._handleConnection, "", self.port)
+		print("Started asyncio HTTP relay on port ", self.port)
+
+	async def close(self):
+		if self._server is None: return
+		self._server.close()
+		await self._server.wait_closed()
+		self._server = None
+
+	async def _handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		host = writer.get_extra_info("peername")[0]
+		try:
+			while True:
+				try: head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepAliveTimeout)
+				except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError): break
+
+				requestLine, _, rawHeaders = head.partition(b"\r\n")
+				try: method, _, version = requestLine.decode("latin-1").split(" ", 2)
+				except ValueError:
+					await self._respond(writer, (400, {}, b""), False)
+					break
+
+				headers = parse_headers(io.BytesIO(rawHeaders))
+				try: body = await reader.readexactly(int(headers.get("Content-Length", 0)))
+				except (ValueError, asyncio.IncompleteReadError):
+					await self._respond(writer, (400, {}, b""), False)
+					break
+
+				connection = headers.get("Connection", "").lower()
+				keepAlive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+				if method == "GET" and headers.get("Poll-Stream") == "1":
+					await self._streamGet(writer, host, headers, keepAlive)
+					if not keepAlive: break
+					continue
+
+				try:
+					if method == "GET": response = await self._handleGet(host, headers)
+					elif method == "POST": response = handlePost(host, headers, body)
+					elif method == "PATCH": response = handlePatch(host, headers)
+					else: response = (501, {}, b"")
+				except Exception:
+					traceback.print_exc()
+					response = (500, {}, b"")
+
+				await self._respond(writer, response, keepAlive)
+				if not keepAlive: break
+		except ConnectionError: pass
+		finally:
+			writer.close()
+
+	async def _waitForDiscord(self, constring: str, timeout: float):
+		'''Wait up to timeout seconds for there to be data to send to this constring'''
+		if timeout <= 0 or hasDiscordData(constring): return
+		try: await asyncio.wait_for(discordEvents[constring].wait(), timeout)
+		except asyncio.TimeoutError: pass
+
+	async def _handleGet(self, host: str, headers: HTTPMessage) -> Response:
+		'''Same as `handleGet`, but long-polls if the client sent a Poll-Timeout header'''
+		try: constring = requestConstring(host, headers, discordMsgs)
+		except RequestError as e: return e.response
+
+		await self._waitForDiscord(constring, getPollTimeout(headers, self.maxPollTimeout))
+		if constring not in discordMsgs: return (403, {}, b"") # Relay was removed while polling
+		return handleGet(host, headers)
+
+	async def _streamGet(self, writer: asyncio.StreamWriter, host: str, headers: HTTPMessage, keepAlive: bool):
+		'''
+		Respond to a GET with a chunked stream, writing a line of JSON (same as a normal GET body) each time there's data,
+		until the Poll-Timeout is reached
+		'''
+		try: constring = requestConstring(host, headers, discordMsgs)
+		except RequestError as e:
+			await self._respond(writer, e.response, keepAlive)
 			return
 
-		if self.headers["Content-type"] != "application/json":
-			print(f"Request MIME type of {self.headers['Content-type']} is invalid")
-			self.send_error(400, explain=f"Request MIME type of {self.headers['Content-type']} is invalid")
-			self.end_headers()
-			return
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + getPollTimeout(headers, self.maxPollTimeout)
+		mimeType = codec.negotiate(headers)
 
-		data = json.loads(self.rfile.read(int(self.headers.get("Content-Length"))))
-		for k in sorted(data):
-			if "type" not in data[k].keys():
-				print("Request type param was not present")
-				self.send_error(400, explain="Request type param was not present")
-				self.end_headers()
-				return
+		writer.write(bytes("\r\n".join([
+			"HTTP/1.1 200 OK",
+			f"Content-type: {mimeType}",
+			"Transfer-Encoding: chunked",
+			f"Connection: {'keep-alive' if keepAlive else 'close'}"
+		]) + "\r\n\r\n", encoding="latin-1"))
 
-			if data[k]["type"] == "message":
-				if "icon" not in data[k]:
-					match = avatarPattern.search(requests.get(f"http://steamcommunity.com/profiles/{data[k]['steamID']}?xml=1").text)
-					if match is not None: match = match.group(1)
-					data[k]["icon"] = "http://example.com/" if match is None else match
+		ready = hasDiscordData(constring)
+		while True:
+			if not ready:
+				try: await asyncio.wait_for(discordEvents[constring].wait(), deadline - loop.time())
+				except asyncio.TimeoutError: break
+			if constring not in discordMsgs: break
+			ready = False
 
-				sourceMsgs[constring]["chat"].append(data[k])
-			elif data[k]["type"] == "join":
-				sourceMsgs[constring]["joins"].append(data[k]["name"])
-			elif data[k]["type"] == "leave":
-				sourceMsgs[constring]["leaves"].append(data[k]["name"])
-			elif data[k]["type"] == "death":
-				sourceMsgs[constring]["deaths"].append((data[k]["victim"], data[k]["inflictor"], data[k]["attacker"], data[k]["suicide"] == "1", data[k]["noweapon"] == "1"))
-			elif data[k]["type"] == "custom":
-				sourceMsgs[constring]["custom"].append(data[k]["body"])
-			else:
-				print(f"Request type param was not valid, got {data[k]['type']}")
-				self.send_error(400, explain="Request type param was not valid")
-				self.end_headers()
-				return
-
-		self.send_response(200)
-		self.end_headers()
-		return
-	
-	def do_PATCH(self):
-		'''Request to get the info payload'''
-		if "Source-Port" not in self.headers:
-			self.send_response(400)
-			self.end_headers()
-			return
+			body = handleGet(host, headers)[2]
+			if mimeType == codec.JSON: body += b"\n" # MessagePack documents are delimited by the chunks alone
+			writer.write(b"%x\r\n%s\r\n" % (len(body), body))
+			await writer.drain()
 
-		constring = f"{self.client_address[0] if self.client_address[0] != '127.0.0.1' else get_ip()}:{self.headers['Source-Port']}"
-		if constring not in sourceMsgs:
-			self.send_response(403)
-			self.end_headers()
-			return
+		writer.write(b"0\r\n\r\n")
+		await writer.drain()
 
-		self.send_response(200)
-		self.end_headers()
+	async def _respond(self, writer: asyncio.StreamWriter, response: Response, keepAlive: bool):
+		status, headers, body = response
 
-		self.wfile.write(bytes(infoPayloads[constring], encoding="utf-8"))
-		payloadDirty[constring] = False
+		head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+		head.extend(f"{header}: {value}" for header, value in headers.items())
+		head.append(f"Content-Length: {len(body)}")
+		head.append(f"Connection: {'keep-alive' if keepAlive else 'close'}")
+
+		writer.write(bytes("\r\n".join(head) + "\r\n\r\n", encoding="latin-1") + body)
+		await writer.drain()
 
 class Relay(object):
 	'''HTTP chat relay for source servers'''
 
-	def __init__(self, port):
+	def __init__(
+		self, port, useAsyncio: bool = False, avatarCache: Optional[str] = None,
+		limits: Optional[Dict[str, int]] = None, policy: str = SUMMARISE,
+		durableQueue: Optional[str] = None, commitInterval: float = 0.05
+	):
+		'''
+		Create the relay, with either a threaded HTTP server (started immediately),
+		or an asyncio one sharing the caller's event loop (started with `start`).
+		If avatarCache is a path, looked up avatars are also cached to disk there.
+		limits overrides the max queue size of each category, and policy is what to do with items that don't fit
+		(RCON commands are never summarised, as they'd be run in the summary's place).
+		If durableQueue is a path, everything queued is logged there and replayed when its constring is added after a restart,
+		with the log committed every commitInterval seconds.
+		'''
+		global queueLock, threadedEngine, overflowPolicy, journal
+
+		# Checked up front, as queues aren't created until a constring is added (which could be in the middle of a command)
+		if policy not in POLICIES: raise ValueError(f"Invalid overflow policy {policy}, must be one of " + ", ".join(POLICIES))
+		if limits is not None:
+			for category in limits:
+				if category not in queueLimits: raise ValueError(f"Invalid queue limit category {category}, must be one of " + ", ".join(queueLimits))
+
+		self.server = None
+		if avatarCache is not None: avatars.store = AvatarStore(avatarCache)
+		if limits is not None: queueLimits.update(limits)
+		overflowPolicy = policy
+
+		self.commitInterval = commitInterval
+		if durableQueue is not None:
+			journal = DurableLog(durableQueue)
+			atexit.register(journal.close)
+
+		if useAsyncio:
+			self.server = AsyncRelayServer(port)
+			return
+
+		queueLock = Lock()
+		threadedEngine = True
+
 		print("Starting relay thread")
 		self.t = Thread(target=relayThread, args=(port,))
 		self.t.daemon = True
 		self.t.start()
-	
-	def setInitPayload(self, constring: str, payload: str):
+
+	async def start(self):
+		'''Bind the relay to the running event loop, and start the asyncio server if in use'''
+		global eventLoop
+		eventLoop = asyncio.get_running_loop()
+
+		if self.server is not None: await self.server.start()
+		if journal is not None: eventLoop.create_task(self._commitJournal())
+
+	async def _commitJournal(self):
+		'''Group commit the journal, so messages are written with one fsync per interval instead of one each'''
+		while True:
+			await asyncio.sleep(self.commitInterval)
+			if journal.dirty: await eventLoop.run_in_executor(None, journal.flush)
+
+	def setInitPayload(self, constring: str, payload: InfoPayload):
 		'''Set the payload to be sent when a client performs an init request'''
 		infoPayloads[constring] = payload
 		payloadDirty[constring] = True
+		signal(discordEvents, constring)
 
 	def addConStr(self, constring: str):
-		discordMsgs[constring] = {"chat": [], "rcon": []}
-		sourceMsgs[constring] = {"chat": [], "joins": [], "leaves": [], "deaths": [], "custom": []}
-		infoPayloads[constring] = ""
+		'''Start relaying a constring, does nothing if it already is (e.g. when on_ready fires again after a reconnect)'''
+		if constring in discordMsgs: return
+
+		lastSeen[constring] = monotonic() # Gives the server until the liveness timeout to start polling
+		discordMsgs[constring] = {
+			"chat": BoundedQueue(queueLimits["chat"], overflowPolicy),
+			"rcon": BoundedQueue(queueLimits["rcon"], DROP_NEWEST if overflowPolicy == SUMMARISE else overflowPolicy)
+		}
+		sourceMsgs[constring] = {
+			category: BoundedQueue(queueLimits[category], overflowPolicy)
+			for category in ("chat", "joins", "leaves", "deaths", "custom")
+		}
+		discordEvents[constring] = asyncio.Event()
+		infoPayloads[constring] = None
 		payloadDirty[constring] = False
+
+		if journal is None: return
+
+		# Requeue anything that wasn't delivered before the last shutdown
+		unacked[constring] = []
+		replayed = journal.replay(constring)
+		with queueLock:
+			for id, direction, category, item in replayed:
+				discarded = (discordMsgs if direction == "discord" else sourceMsgs)[constring][category].append(item, id)
+				if discarded is not None: journal.ack((discarded,))
+
+		if any(direction == "source" for _, direction, _, _ in replayed): onLoop(markSourceReady, constring)
+		if any(direction == "discord" for _, direction, _, _ in replayed): signal(discordEvents, constring)
+
 	def removeConStr(self, constring: str):
+		if journal is not None:
+			# Anything still queued is dropped with the relay
+			with queueLock:
+				for queue in list(discordMsgs[constring].values()) + list(sourceMsgs[constring].values()):
+					journal.ack(queue.drainWithKeys()[1])
+			journal.ack(unacked.pop(constring))
+
 		del discordMsgs[constring]
 		del sourceMsgs[constring]
+		signal(discordEvents, constring) # Release any long-polls for this constring
+		del discordEvents[constring]
 		del infoPayloads[constring]
 		del payloadDirty[constring]
 
 	def isConStrAdded(self, constring: str) -> bool:
 		return constring in infoPayloads
 
+	def secondsSinceSeen(self, constring: str) -> Optional[float]:
+		'''Time since a server last made a request (or its relay was added), None if it's never been relayed'''
+		if constring not in lastSeen: return None
+		return monotonic() - lastSeen[constring]
+
 	def addMessage(self, msg: tuple, constring: str):
-		discordMsgs[constring]["chat"].append(msg)
+		with queueLock: enqueue(discordMsgs[constring], constring, "discord", "chat", msg)
+		signal(discordEvents, constring)
 
 	def addRCON(self, command: str, constring: str):
-		discordMsgs[constring]["rcon"].append(command)
+		with queueLock: enqueue(discordMsgs[constring], constring, "discord", "rcon", command)
+		signal(discordEvents, constring)
+
+	async def resolveIcon(self, msg: dict) -> str:
+		'''Get the icon URL for a relayed chat message, looking up the author's steam avatar if it wasn't sent'''
+		if "icon" not in msg: msg["icon"] = await avatars.resolve(msg["steamID"])
+		return msg["icon"]
+
+	async def waitForReady(self) -> set:
+		'''Wait until any constrings have source messages, and return the set of them'''
+		global readySources
+		await readyEvent.wait()
+		readyEvent.clear()
+
+		ready = readySources
+		readySources = set()
+		return ready
+
+	def _take(self, constring: str, *categories: str) -> tuple:
+		'''Swap out the given source queues'''
+		with queueLock:
+			queues = sourceMsgs[constring]
+			ret = []
+			for category in categories:
+				items, ids = queues[category].drainWithKeys()
+				ret.append(items)
+				if journal is not None: unacked[constring].extend(ids)
+		return tuple(ret)
 
 	def getMessages(self, constring: str) -> list:
-		ret = sourceMsgs[constring]["chat"]
-		sourceMsgs[constring]["chat"] = []
-		return ret
+		return self._take(constring, "chat")[0]
 
 	def getJoinsAndLeaves(self, constring: str) -> tuple:
-		ret = (sourceMsgs[constring]["joins"], sourceMsgs[constring]["leaves"])
-		sourceMsgs[constring]["joins"] = []
-		sourceMsgs[constring]["leaves"] = []
-		return ret
+		return self._take(constring, "joins", "leaves")
 
 	def getDeaths(self, constring: str) -> list:
-		ret = sourceMsgs[constring]["deaths"]
-		sourceMsgs[constring]["deaths"] = []
-		return ret
+		return self._take(constring, "deaths")[0]
 
 	def getCustom(self, constring: str) -> list:
-		ret = sourceMsgs[constring]["custom"]
-		sourceMsgs[constring]["custom"] = []
-		return ret
+		return self._take(constring, "custom")[0]
+
+	def ack(self, constring: str):
+		'''Acknowledge that the source messages taken for a constring have been delivered, so they won't be replayed'''
+		if journal is None or constring not in unacked: return
+		journal.ack(unacked[constring])
+		unacked[constring] = []
+
+	def getOverflowSummaries(self, constring: str) -> list:
+		'''Get a line summarising the source messages of each category that were discarded since this was last called'''
+		summaries = []
+		with queueLock:
+			for category, queue in sourceMsgs[constring].items():
+				skipped = queue.takeSkipped()
+				if skipped != 0: summaries.append(f"…and {skipped} more {OVERFLOW_NOUNS[category]}")
+		return summaries
+
+	def getOverflowCounts(self, constring: str) -> Dict[str, int]:
+		'''Get the total number of items discarded from each of a constring's queues'''
+		counts = {f"discord {category}": queue.overflowed for category, queue in discordMsgs[constring].items()}
+		counts.update({f"game {category}": queue.overflowed for category, queue in sourceMsgs[constring].items()})
+		return counts
 
 if __name__ == "__main__":
 	r = Relay(8080)
 	try:
 		while True: sleep(10)
-	except KeyboardInterrupt: pass
\ No newline at end of file
+	except KeyboardInterrupt: pass